@@ -1,16 +1,22 @@
 """(c) All rights reserved. ECOLE POLYTECHNIQUE FEDERALE DE LAUSANNE, Switzerland, VPSI, 2017"""
 
+import hashlib
 import logging
 import os
+import re
+import threading
 import timeit
 from collections import OrderedDict
 from datetime import timedelta
+from functools import partial
+from multiprocessing.pool import ThreadPool
 from pathlib import Path
 
 import requests
-from clint.textui import progress
+from requests.adapters import HTTPAdapter
 
-from settings import JAHIA_SITES
+from crawler.manifest import Manifest
+from settings import JAHIA_SITES, DOWNLOAD_CHUNK_SIZE, DOWNLOAD_PREALLOCATE, DOWNLOAD_PROGRESS_INTERVAL
 from utils import Utils
 
 """
@@ -32,6 +38,9 @@ class SiteCrawler(object):
         * '-n' & '-s': or how many sites to download from JAHIA_SITES, where from
         * '--date': what date should be asked to Jahia
         * '--force': if existing downloaded files should be overriden or not
+        * '--crawl-workers': how many sites to download at the same time
+        * '--incremental' & '--max-age': download only the sites that changed
+          since their last snapshot, see download_site
      """
 
     # define HOST
@@ -51,33 +60,50 @@ class SiteCrawler(object):
     }
 
     FILE_PATTERN = "%s_export_%s.zip"
+    # the size of the chunks read from the response and written to the file
+    CHUNK_SIZE = DOWNLOAD_CHUNK_SIZE * 1024 * 1024
+    # the files being downloaded, renamed once complete
+    PART_SUFFIX = ".part"
     TRACER = "tracer_crawling.csv"
 
-    # singleton, with lazy initialization
+    # singleton, with lazy initialization, shared by all the downloads
     __session = None
+    # the size of the HTTP connection pool of the session, one connection per worker
+    __pool_size = 1
+
+    # the downloading threads authenticate only once, and write the tracer one at a time
+    __session_lock = threading.Lock()
+    __tracer_lock = threading.Lock()
 
     @property
     def session(self):
         """
             Make a POST on Jahia administration to get a valid session
         """
-        if self.__session is None:
-            # lazy initialization
-            logging.info("authenticating...")
-            session = requests.Session()
-            response = session.post(
-                "%s/%s" % (self.HOST, self.ID_URI),
-                params=self.ID_GET_PARAMS,
-                data=self.get_credentials()
-            )
-
-            # log and set session
-            logging.info("requested %s", response.url)
-            logging.debug("returned %s", response.status_code)
-            self.__session = session
+        with SiteCrawler.__session_lock:
+            if SiteCrawler.__session is None:
+                # lazy initialization
+                logging.info("authenticating...")
+                session = requests.Session()
+
+                # requests keeps 10 connections by default
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max(SiteCrawler.__pool_size, 10))
+                session.mount("http://", adapter)
+                session.mount("https://", adapter)
+
+                response = session.post(
+                    "%s/%s" % (self.HOST, self.ID_URI),
+                    params=self.ID_GET_PARAMS,
+                    data=self.get_credentials()
+                )
+
+                # log and set session
+                logging.info("requested %s", response.url)
+                logging.debug("returned %s", response.status_code)
+                SiteCrawler.__session = session
 
         # cls.session is set, return it
-        return self.__session
+        return SiteCrawler.__session
 
     @staticmethod
     def get_credentials():
@@ -87,6 +113,19 @@ class SiteCrawler(object):
             'login_password': Utils.get_required_env('JAHIA_ROOT_PASSWORD')
         }
 
+    @staticmethod
+    def get_sites(cmd_args):
+        """
+            Returns the list of sites to download: 'cmd_args.number' sites from
+            JAHIA_SITES, starting at 'cmd_args.site_name'
+        """
+        try:
+            start_at = JAHIA_SITES.index(cmd_args['<site>'])
+        except ValueError:
+            raise SystemExit("site name %s not found in JAHIA_SITES", cmd_args['<site>'])
+        end = start_at + int(cmd_args['--number'])
+        return JAHIA_SITES[start_at:end]
+
     @classmethod
     def download(cls, cmd_args):
         """
@@ -101,24 +140,46 @@ class SiteCrawler(object):
         # to store paths of downloaded zips
         downloaded_files = OrderedDict()
 
-        # compute list fo sites to download
-        try:
-            start_at = JAHIA_SITES.index(cmd_args['<site>'])
-        except ValueError:
-            raise SystemExit("site name %s not found in JAHIA_SITES", cmd_args['<site>'])
-        end = start_at + int(cmd_args['--number'])
-        sites = JAHIA_SITES[start_at:end]
+        sites = cls.get_sites(cmd_args)
+        workers = int(cmd_args['--crawl-workers'])
 
         # download sites from JAHIA_SITES
-        for site in sites:
-            try:
-                downloaded_files[site] = str(cls(site, cmd_args).download_site())
-            except Exception as err:
-                logging.error("%s - crawl - Could not crawl Jahia - Exception: %s", site, err)
+        if workers > 1 and len(sites) > 1:
+            logging.info("downloading %s sites with %s workers...", len(sites), workers)
+            cls.set_pool_size(workers)
+
+            with ThreadPool(processes=workers) as pool:
+                zip_files = pool.map(partial(cls.download_one, cmd_args=cmd_args), sites)
+        else:
+            zip_files = [cls.download_one(site, cmd_args) for site in sites]
+
+        for site, zip_file in zip(sites, zip_files):
+            if zip_file:
+                downloaded_files[site] = zip_file
 
         # return results, as strings
         return downloaded_files
 
+    @classmethod
+    def set_pool_size(cls, pool_size):
+        """
+            Set the size of the HTTP connection pool, before the session is created
+        """
+        with SiteCrawler.__session_lock:
+            SiteCrawler.__pool_size = pool_size
+
+    @classmethod
+    def download_one(cls, site_name, cmd_args):
+        """
+            Download the given site
+
+            returns the path of the downloaded file, as string, or None if it failed
+        """
+        try:
+            return str(cls(site_name, cmd_args).download_site())
+        except Exception as err:
+            logging.error("%s - crawl - Could not crawl Jahia - Exception: %s", site_name, err)
+
     def __init__(self, site_name, cmd_args):
         self.site_name = site_name
         # jahia download URI depends on date
@@ -129,35 +190,85 @@ class SiteCrawler(object):
         self.output_path = cmd_args['--output-dir']
         # whether overriding existing zip or not
         self.force = cmd_args['--force-crawl']
+        # whether checking if the existing zip is up to date or not
+        self.incremental = cmd_args.get('--incremental', False)
+        # with incremental, the age in hours under which a zip is up to date
+        self.max_age = float(cmd_args.get('--max-age') or 0)
+        # what we know about the last zip
+        self.manifest = Manifest(self.export_path, self.site_name)
         # to measure overall download time for given site
         self.elapsed = 0
+        # the download speed, in MB/s
+        self.throughput = 0
 
         # adapt file_path to cmd_args
         existing = self.already_downloaded()
-        if existing and not self.force:
+        if existing and not self.force and not self.incremental:
             self.file_path = existing[-1]
             self.file_name = os.path.basename(self.file_path)
         else:
             self.file_name = self.FILE_PATTERN % (self.site_name, self.date)
             self.file_path = os.path.join(self.export_path, self.file_name)
 
+        # where the file is written until it's complete
+        self.part_path = self.file_path + self.PART_SUFFIX
+
     def __str__(self):
         """ Format used for report"""
-        return ";".join([self.site_name, self.file_path, str(self.elapsed)])
+        return ";".join([self.site_name, self.file_path, str(self.elapsed), "%.6f" % self.throughput])
 
     def already_downloaded(self):
+        """
+            Returns the complete downloads of the site, the last one being the most recent
+        """
         path = Path(self.export_path)
 
-        return [str(file_path) for file_path in path.glob("%s_export*" % self.site_name)]
+        return sorted(str(file_path) for file_path in path.glob("%s_export*" % self.site_name)
+                      if not file_path.name.endswith(self.PART_SUFFIX))
+
+    def partially_downloaded(self):
+        """
+            Returns the interrupted downloads of the site, the last one being the most recent.
+            Only the one of --date can be resumed, Jahia exports the site again for each date
+        """
+        path = Path(self.export_path)
+
+        return sorted(str(file_path) for file_path in path.glob("%s_export*%s" % (self.site_name, self.PART_SUFFIX)))
 
     def download_site(self):
+        """
+            Download the site zip, unless it's already downloaded.
+
+            With --incremental, the last snapshot recorded in the manifest is kept if
+            it's more recent than --max-age hours. Otherwise, we ask Jahia for the zip
+            only if the site was modified since the last jcr:lastModified found by
+            the parser (If-Modified-Since).
+
+            Only --max-age is sure to skip the download: whether Jahia answers If-Modified-Since
+            with a 304 has not been checked. If it ignores it and returns the zip, the zip is
+            downloaded again as without --incremental.
+        """
         # do not download twice if not --force
         existing = self.already_downloaded()
-        if existing and not self.force:
+        if existing and not self.force and not self.incremental:
             logging.warning("%s already downloaded %sx. Last one is %s",
                             self.site_name, len(existing), self.file_path)
             return self.file_path
 
+        headers = {}
+
+        # check if the last snapshot is up to date
+        snapshot = self.manifest.get_snapshot() if self.incremental and not self.force else None
+        if snapshot:
+            age = self.manifest.get_age()
+            if age is not None and age < self.max_age:
+                logging.info("%s snapshot is %.1f hours old, keeping %s", self.site_name, age, snapshot)
+                return snapshot
+
+            if_modified_since = self.manifest.get_if_modified_since()
+            if if_modified_since:
+                headers['If-Modified-Since'] = if_modified_since
+
         # pepare query
         params = self.DWLD_GET_PARAMS.copy()
         params['sitebox'] = self.site_name
@@ -165,47 +276,201 @@ class SiteCrawler(object):
         # set timer to measure execution time
         start_time = timeit.default_timer()
 
+        # the interrupted downloads of other dates can't be resumed
+        for part_path in self.partially_downloaded():
+            if part_path != self.part_path:
+                logging.info("removing %s, interrupted download of another date", part_path)
+                os.remove(part_path)
+
+        # resume the interrupted download, if any
+        offset = 0
+        if os.path.isfile(self.part_path) and not self.force:
+            offset = os.path.getsize(self.part_path)
+            headers['Range'] = "bytes=%s-" % offset
+            logging.info("resuming %s from byte %s...", self.file_name, offset)
+
         # make query
+        response = self.request_export(params, headers)
+
+        # the site was not modified since the last snapshot
+        if snapshot and response.status_code == requests.codes.not_modified:
+            logging.info("%s not modified since %s, keeping %s",
+                         self.site_name, headers['If-Modified-Since'], snapshot)
+            self.manifest.set_checked()
+            self.manifest.save()
+            return snapshot
+
+        if offset:
+            offset, response = self.check_resumed(response, offset, params)
+
+        # the part file is already complete
+        if response is None:
+            return self.complete_download(start_time, start_time, 0, None)
+
+        # raise exception in case of error
+        if response.status_code not in (requests.codes.ok, requests.codes.partial_content):
+            response.raise_for_status()
+
+        # the size to download, from the content-length in header
+        logging.debug("headers %s", response.headers)
+        total_length = response.headers.get('content-length')
+        if total_length is not None:
+            total_length = int(total_length)
+
+        # download file, in large chunks written through a buffer as large
+        logging.info("saving response into %s...", self.part_path)
+        size = 0
+        checksum = hashlib.sha256() if not offset else None
+        transfer_start = timeit.default_timer()
+        with open(self.part_path, 'r+b' if offset else 'wb', buffering=self.CHUNK_SIZE) as output:
+            output.seek(offset)
+
+            if total_length is not None and DOWNLOAD_PREALLOCATE:
+                self.preallocate(output, offset + total_length)
+
+            try:
+                last_progress = transfer_start
+
+                for chunk in response.iter_content(chunk_size=self.CHUNK_SIZE):
+                    output.write(chunk)
+                    size += len(chunk)
+
+                    if checksum:
+                        checksum.update(chunk)
+
+                    now = timeit.default_timer()
+                    if now - last_progress >= DOWNLOAD_PROGRESS_INTERVAL:
+                        self.log_progress(offset + size, total_length and offset + total_length, now - transfer_start)
+                        last_progress = now
+            finally:
+                # drop the preallocated space that was not written, to resume at the right place
+                output.truncate(offset + size)
+
+        # keep the part file to resume later if the transfer was cut
+        if total_length is not None:
+            expected_size = offset + total_length
+            size = os.path.getsize(self.part_path)
+            if size != expected_size:
+                raise IOError("incomplete download of %s: %s bytes instead of %s" % (
+                    self.file_name, size, expected_size))
+
+        return self.complete_download(start_time, transfer_start, size, checksum)
+
+    def request_export(self, params, headers):
+        """
+            Ask Jahia for the site zip, returns the streamed response
+        """
         logging.debug("downloading %s...", self.file_name)
         response = self.session.post(
             "%s/%s/%s" % (self.HOST, self.DWLD_URI, self.file_name),
             params=params,
+            headers=headers,
             stream=True
         )
         logging.debug("requested %s", response.url)
         logging.debug("returned %s", response.status_code)
 
-        # raise exception in case of error
-        if not response.status_code == requests.codes.ok:
-            response.raise_for_status()
+        return response
 
-        # adapt streaming function to content-length in header
-        logging.debug("headers %s", response.headers)
-        total_length = response.headers.get('content-length')
-        if total_length is not None:
-            def read_stream():
-                return progress.bar(
-                    response.iter_content(chunk_size=4096),
-                    expected_size=(int(total_length) / 4096) + 1)
+    def check_resumed(self, response, offset, params):
+        """
+            Check that the response to a Range request resumes the part file at the given
+            offset. Returns the offset where the response starts and the response, None if
+            the part file is already complete. Otherwise the part file is discarded and the
+            whole zip is asked again
+        """
+        if response.status_code == requests.codes.ok:
+            logging.info("%s does not support resuming, downloading from the beginning", self.HOST)
+            return 0, response
+
+        if response.status_code == requests.codes.partial_content:
+            start, total_size = self.parse_content_range(response.headers.get('content-range'))
+
+            if start == offset:
+                return offset, response
+
+            logging.info("%s resumed at byte %s instead of %s, downloading from the beginning",
+                         self.file_name, start, offset)
+        elif response.status_code == requests.codes.requested_range_not_satisfiable:
+            start, total_size = self.parse_content_range(response.headers.get('content-range'))
+            response.close()
+
+            if total_size == offset:
+                logging.info("%s is already complete", self.part_path)
+                return offset, None
+
+            logging.info("%s can not be resumed, downloading from the beginning", self.file_name)
         else:
-            def read_stream():
-                return response.iter_content(chunk_size=4096)
-
-        # download file
-        logging.info("saving response into %s...", self.file_path)
-        with open(self.file_path, 'wb') as output:
-            for chunk in read_stream():
-                if chunk:
-                    output.write(chunk)
-                    output.flush()
+            # an error, raised by the caller
+            return offset, response
+
+        response.close()
+        os.remove(self.part_path)
+
+        return 0, self.request_export(params, {})
+
+    @staticmethod
+    def parse_content_range(content_range):
+        """
+            Returns the first byte and the total size of the given Content-Range header,
+            e.g. "bytes 100-199/200" or "bytes */200". They are None if they are unknown
+        """
+        match = re.match(r"bytes\s+(?:(\d+)-\d+|\*)/(\d+|\*)", content_range or "")
+
+        if not match:
+            return None, None
+
+        start, total_size = match.groups()
+        return (int(start) if start else None), (int(total_size) if total_size != "*" else None)
 
-        # log execution time and return path to downloaded file
-        self.elapsed = timedelta(seconds=timeit.default_timer() - start_time)
-        logging.info("file downloaded in %s", self.elapsed)
+    def complete_download(self, start_time, transfer_start, size, checksum):
+        """
+            Give the complete part file its final name, record it in the manifest and
+            in the tracer. Returns the path of the downloaded file
+        """
+        # only complete files have the final name
+        os.replace(self.part_path, self.file_path)
+
+        # the checksum of a resumed download covers the whole file
+        self.manifest.set_snapshot(
+            self.file_path, checksum.hexdigest() if checksum else Manifest.get_checksum(self.file_path))
+        self.manifest.save()
+
+        # log execution time and return path to downloaded file. The throughput
+        # does not count the time Jahia takes to generate the export
+        now = timeit.default_timer()
+        self.elapsed = timedelta(seconds=now - start_time)
+        self.throughput = size / (1024 * 1024) / (now - transfer_start)
+        logging.info("file downloaded in %s (%.2f MB/s)", self.elapsed, self.throughput)
         tracer_path = os.path.join(self.output_path, self.TRACER)
-        with open(tracer_path, 'a') as tracer:
-            tracer.write(str(self))
+        with SiteCrawler.__tracer_lock, open(tracer_path, 'a') as tracer:
+            tracer.write("%s\n" % self)
             tracer.flush()
 
         # return PosixPath converted to string
         return self.file_path
+
+    def log_progress(self, size, total_size, seconds):
+        """
+            Log the number of MB downloaded, out of total_size if it's known
+        """
+        mega = 1024 * 1024
+
+        if total_size:
+            logging.info("%s - %.1f / %.1f MB downloaded (%.2f MB/s)",
+                         self.site_name, size / mega, total_size / mega, size / mega / seconds)
+        else:
+            logging.info("%s - %.1f MB downloaded (%.2f MB/s)", self.site_name, size / mega, size / mega / seconds)
+
+    @staticmethod
+    def preallocate(output, size):
+        """
+            Reserve the disk space of the given file, if the system supports it
+        """
+        if not hasattr(os, 'posix_fallocate'):
+            return
+
+        try:
+            os.posix_fallocate(output.fileno(), 0, size)
+        except OSError as err:
+            logging.debug("could not preallocate %s bytes: %s", size, err)
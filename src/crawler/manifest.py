@@ -0,0 +1,107 @@
+"""(c) All rights reserved. ECOLE POLYTECHNIQUE FEDERALE DE LAUSANNE, Switzerland, VPSI, 2017"""
+
+import calendar
+import hashlib
+import json
+import logging
+import os
+from datetime import datetime
+from email.utils import formatdate
+
+from settings import JAHIA_DATE_FORMAT
+
+
+class Manifest(object):
+    """
+        What we know about the last snapshot of a site, saved as JSON next to
+        the zip files:
+
+        * 'file_path': the zip file
+        * 'date': when it was downloaded, or last found unchanged on Jahia
+        * 'size' & 'checksum': the size and the sha256 of the zip file
+        * 'last_modified': the most recent jcr:lastModified of the site pages,
+          set by the parser when it parses the snapshot
+    """
+
+    FILE_PATTERN = "%s_manifest.json"
+
+    def __init__(self, export_path, site_name):
+        self.path = os.path.join(export_path, self.FILE_PATTERN % site_name)
+        self.data = {}
+
+        if os.path.isfile(self.path):
+            try:
+                with open(self.path) as manifest_file:
+                    self.data = json.load(manifest_file)
+            except ValueError as err:
+                logging.warning("%s - crawl - Invalid manifest %s: %s", site_name, self.path, err)
+
+    def save(self):
+        """Write the manifest, atomically so that it's never half written"""
+        tmp_path = self.path + ".tmp"
+
+        with open(tmp_path, 'w') as manifest_file:
+            json.dump(self.data, manifest_file, indent=2, sort_keys=True)
+
+        os.replace(tmp_path, self.path)
+
+    def set_snapshot(self, file_path, checksum):
+        """Record the given zip file as the last snapshot"""
+        self.data['file_path'] = file_path
+        self.data['size'] = os.path.getsize(file_path)
+        self.data['checksum'] = checksum
+        self.set_checked()
+
+    def set_checked(self):
+        """Record that the snapshot is up to date, as of now"""
+        self.data['date'] = datetime.now().strftime(JAHIA_DATE_FORMAT)
+
+    def set_last_modified(self, last_modified):
+        """Record the most recent modification date found in the site"""
+        self.data['last_modified'] = last_modified.strftime(JAHIA_DATE_FORMAT)
+
+    def get_snapshot(self):
+        """
+            Returns the zip file of the last snapshot, or None if it's missing or
+            has been modified since
+        """
+        file_path = self.data.get('file_path')
+
+        if not file_path or not os.path.isfile(file_path) or os.path.getsize(file_path) != self.data.get('size'):
+            return None
+
+        return file_path
+
+    def is_snapshot(self, checksum):
+        """Returns whether the zip with the given sha256 is the last snapshot"""
+        return bool(checksum) and self.get_snapshot() is not None and checksum == self.data.get('checksum')
+
+    def get_age(self):
+        """Returns the age of the snapshot in hours, or None if unknown"""
+        if 'date' not in self.data:
+            return None
+
+        date = datetime.strptime(self.data['date'], JAHIA_DATE_FORMAT)
+        return (datetime.now() - date).total_seconds() / 3600
+
+    def get_if_modified_since(self):
+        """
+            Returns the last modification date found in the site as an HTTP date,
+            or None if the site has not been parsed yet
+        """
+        if 'last_modified' not in self.data:
+            return None
+
+        last_modified = datetime.strptime(self.data['last_modified'], JAHIA_DATE_FORMAT)
+        return formatdate(calendar.timegm(last_modified.timetuple()), usegmt=True)
+
+    @staticmethod
+    def get_checksum(file_path):
+        """Returns the sha256 of the given file"""
+        checksum = hashlib.sha256()
+
+        with open(file_path, 'rb') as input:
+            for block in iter(lambda: input.read(1024 * 1024), b""):
+                checksum.update(block)
+
+        return checksum.hexdigest()
@@ -3,11 +3,17 @@
     Testing the crawl.py script
 """
 import os
+import threading
+from datetime import datetime
+from email.utils import parsedate_to_datetime
+from http.server import BaseHTTPRequestHandler, HTTPServer
 from importlib import reload
+from socketserver import ThreadingMixIn
 
 import pytest
 
 import crawler
+from crawler.manifest import Manifest
 
 
 JAHIA_HOST = "https://fake-jahia.epfl.ch"
@@ -67,3 +73,216 @@ class TestSetup:
             'login_username': JAHIA_ROOT_USER,
             'login_password': JAHIA_ROOT_PASSWORD,
         }
+
+
+class JahiaHandler(BaseHTTPRequestHandler):
+    """
+        Fake Jahia: records the requests and returns a small zip for each export
+    """
+    requests = []
+    # the first byte of the partial responses, instead of the one requested
+    range_start = None
+
+    def do_POST(self):
+        self.requests.append(self.path.split("?")[0])
+        body = b"zip content"
+        offset = 0
+
+        # the site was modified on 2017-01-10
+        if_modified_since = self.headers.get("If-Modified-Since")
+        if if_modified_since and parsedate_to_datetime(if_modified_since).day >= 10:
+            self.send_response(304)
+            self.end_headers()
+            return
+
+        if self.headers.get("Range"):
+            offset = int(self.headers["Range"][6:-1])
+
+            if offset >= len(body):
+                self.send_response(416)
+                self.send_header("Content-Range", "bytes */%s" % len(body))
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+
+            if self.range_start is not None:
+                offset = self.range_start
+            self.send_response(206)
+            self.send_header("Content-Range", "bytes %s-%s/%s" % (offset, len(body) - 1, len(body)))
+        else:
+            self.send_response(200)
+
+        self.send_header("Content-Length", str(len(body) - offset))
+        self.end_headers()
+        self.wfile.write(body[offset:])
+
+    def log_message(self, *args):
+        pass
+
+
+class ThreadingServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+@pytest.fixture()
+def jahia(environment):
+    """
+    Start a fake Jahia and reset the crawler session
+    """
+    JahiaHandler.requests = []
+    JahiaHandler.range_start = None
+    server = ThreadingServer(("127.0.0.1", 0), JahiaHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    crawler.SiteCrawler.HOST = "http://127.0.0.1:%s" % server.server_port
+    yield JahiaHandler.requests
+    server.shutdown()
+
+
+def get_cmd_args(tmpdir, sites, crawl_workers=1, incremental=False, max_age=0):
+    return {
+        '<site>': sites[0],
+        '--number': len(sites),
+        '--date': "2017-01-15-23-00",
+        '--export-path': str(tmpdir),
+        '--output-dir': str(tmpdir),
+        '--force-crawl': False,
+        '--crawl-workers': crawl_workers,
+        '--incremental': incremental,
+        '--max-age': max_age,
+    }
+
+
+class TestDownload:
+
+    def test_concurrent_download(self, jahia, tmpdir):
+        sites = crawler.JAHIA_SITES[:3]
+        downloaded_files = crawler.SiteCrawler.download(get_cmd_args(tmpdir, sites, crawl_workers=3))
+
+        # in the order of JAHIA_SITES
+        assert list(downloaded_files.keys()) == sites
+        for site in sites:
+            with open(downloaded_files[site], 'rb') as zip_file:
+                assert zip_file.read() == b"zip content"
+
+        # authenticated only once
+        assert jahia.count("/administration") == 1
+        assert len(jahia) == 4
+
+        # one tracer line per site
+        lines = tmpdir.join(crawler.SiteCrawler.TRACER).readlines()
+        assert sorted(line.split(";")[0] for line in lines) == sites
+        # with the throughput in MB/s, precise enough for such small files
+        assert all(float(line.split(";")[3]) > 0 for line in lines)
+
+    def test_optional_args(self, jahia, tmpdir):
+        # e.g. the arguments of the generator
+        site = crawler.JAHIA_SITES[0]
+        cmd_args = get_cmd_args(tmpdir, [site])
+        del cmd_args['--incremental']
+        del cmd_args['--max-age']
+        site_crawler = crawler.SiteCrawler(site, cmd_args)
+        assert not site_crawler.incremental
+        assert site_crawler.max_age == 0
+        assert os.path.isfile(site_crawler.download_site())
+
+    def test_preallocate(self, jahia, tmpdir, monkeypatch):
+        monkeypatch.setattr(crawler, "DOWNLOAD_PREALLOCATE", True)
+        site = crawler.JAHIA_SITES[0]
+        file_path = crawler.SiteCrawler(site, get_cmd_args(tmpdir, [site])).download_site()
+        with open(file_path, 'rb') as zip_file:
+            assert zip_file.read() == b"zip content"
+
+    def test_resume(self, jahia, tmpdir):
+        site = crawler.JAHIA_SITES[0]
+        # an interrupted download of the same date, and one from a previous day
+        part = tmpdir.join("%s_export_2017-01-15-23-00.zip.part" % site)
+        part.write("zip ")
+        stale_part = tmpdir.join("%s_export_2017-01-14-23-00.zip.part" % site)
+        stale_part.write("old ")
+
+        site_crawler = crawler.SiteCrawler(site, get_cmd_args(tmpdir, [site]))
+        assert site_crawler.already_downloaded() == []
+
+        file_path = site_crawler.download_site()
+        assert file_path == str(tmpdir.join("%s_export_2017-01-15-23-00.zip" % site))
+        with open(file_path, 'rb') as zip_file:
+            assert zip_file.read() == b"zip content"
+        assert not part.exists()
+        assert not stale_part.exists()
+        assert site_crawler.already_downloaded() == [file_path]
+
+    def test_resume_elsewhere(self, jahia, tmpdir):
+        site = crawler.JAHIA_SITES[0]
+        part = tmpdir.join("%s_export_2017-01-15-23-00.zip.part" % site)
+        part.write("xxxx")
+
+        # Jahia does not resume at the requested byte: downloaded again from the beginning
+        JahiaHandler.range_start = 0
+        file_path = crawler.SiteCrawler(site, get_cmd_args(tmpdir, [site])).download_site()
+        with open(file_path, 'rb') as zip_file:
+            assert zip_file.read() == b"zip content"
+        assert len(jahia) == 3
+
+    def test_resume_not_satisfiable(self, jahia, tmpdir):
+        site = crawler.JAHIA_SITES[0]
+        part = tmpdir.join("%s_export_2017-01-15-23-00.zip.part" % site)
+
+        # the part is already complete
+        part.write("zip content")
+        file_path = crawler.SiteCrawler(site, get_cmd_args(tmpdir, [site])).download_site()
+        with open(file_path, 'rb') as zip_file:
+            assert zip_file.read() == b"zip content"
+        assert Manifest(str(tmpdir), site).get_snapshot() == file_path
+        assert len(jahia) == 2
+
+        # the part is larger than the zip: downloaded again from the beginning
+        os.remove(file_path)
+        part.write("zip content, and more")
+        file_path = crawler.SiteCrawler(site, get_cmd_args(tmpdir, [site])).download_site()
+        with open(file_path, 'rb') as zip_file:
+            assert zip_file.read() == b"zip content"
+        assert len(jahia) == 4
+
+    def test_incremental(self, jahia, tmpdir):
+        site = crawler.JAHIA_SITES[0]
+        first_path = crawler.SiteCrawler(site, get_cmd_args(tmpdir, [site])).download_site()
+        manifest = Manifest(str(tmpdir), site)
+        assert manifest.get_snapshot() == first_path
+        assert manifest.data['checksum'] == Manifest.get_checksum(first_path)
+
+        # recent snapshot: Jahia is not asked
+        cmd_args = get_cmd_args(tmpdir, [site], incremental=True, max_age=24)
+        cmd_args['--date'] = "2017-01-16-23-00"
+        assert crawler.SiteCrawler(site, cmd_args).download_site() == first_path
+        assert len(jahia) == 2
+
+        # not modified since the last parsing
+        cmd_args['--max-age'] = 0
+        manifest.set_last_modified(datetime(2017, 1, 12))
+        manifest.save()
+        assert crawler.SiteCrawler(site, cmd_args).download_site() == first_path
+        assert len(jahia) == 3
+
+        # modified since the last parsing
+        manifest.set_last_modified(datetime(2017, 1, 8))
+        manifest.save()
+        second_path = crawler.SiteCrawler(site, cmd_args).download_site()
+        assert second_path != first_path
+        assert Manifest(str(tmpdir), site).get_snapshot() == second_path
+
+    def test_is_snapshot(self, jahia, tmpdir):
+        site = crawler.JAHIA_SITES[0]
+        file_path = crawler.SiteCrawler(site, get_cmd_args(tmpdir, [site])).download_site()
+        manifest = Manifest(str(tmpdir), site)
+
+        assert manifest.is_snapshot(Manifest.get_checksum(file_path))
+        assert not manifest.is_snapshot(None)
+
+        # another zip, e.g. given with --from-zip
+        other_zip = tmpdir.join("other.zip")
+        other_zip.write("other zip content")
+        assert not manifest.is_snapshot(Manifest.get_checksum(str(other_zip)))
+
+        # the snapshot is gone
+        os.remove(file_path)
+        assert not manifest.is_snapshot(manifest.data['checksum'])
@@ -5,9 +5,11 @@ import os
 import shutil
 import logging
 
-from bs4 import BeautifulSoup
 from jinja2 import Environment, PackageLoader, select_autoescape
 
+from parser.links import rewrite_links
+from parser.site_source import copy_file
+
 
 class HTMLExporter:
 
@@ -16,6 +18,9 @@ class HTMLExporter:
         autoescape=select_autoescape(['html', 'xml'])
     )
 
+    # the files and directories that are not exported
+    FILES_TO_IGNORE = ["thumbnail", "thumbnail2"]
+
     def __init__(self, site, out_path):
 
         # if True we add an .html extension to pages without an extension
@@ -67,27 +72,23 @@ class HTMLExporter:
 
         # next fix all the links in the boxes
         for box in self.site.get_all_boxes():
-            soup = BeautifulSoup(box.content, 'html.parser')
-
-            tags = soup.find_all("a")
-
-            for tag in tags:
-                link = tag.get("href")
+            box.content = rewrite_links(box.content, self.add_link_html_extension, link_attributes={"a": "href"})
 
-                if not link:
-                    continue
+    @staticmethod
+    def add_link_html_extension(tag_name, link):
+        """Returns the given link with an .html extension, or None if it's kept as is"""
 
-                # we change only relative links
-                if link.startswith("/"):
-                    dirname = os.path.dirname(link)
-                    basename = os.path.basename(link)
+        # we change only relative links
+        if link.startswith("/"):
+            dirname = os.path.dirname(link)
+            basename = os.path.basename(link)
 
-                    if "." not in basename:
-                        basename += ".html"
+            if "." not in basename:
+                basename += ".html"
 
-                        tag["href"] = os.path.join(dirname, basename)
+                return os.path.join(dirname, basename)
 
-            box.content = str(soup)
+        return None
 
     def generate_pages(self):
         """Generate the pages & the sitemap"""
@@ -237,14 +238,11 @@ class HTMLExporter:
         if page.is_homepage():
             self.sitemap_content += "</ul>"
 
-    @staticmethod
-    def files_to_ignore(dirs, files):
-        return ["thumbnail", "thumbnail2"]
-
     def extract_files(self):
-        """Extract the files"""
+        """Extract the files, straight from the site source (see site_source)"""
+        start = "%s/content/sites/%s/files" % (self.site.base_path, self.site.name)
 
-        if not os.path.isdir(os.path.join(self.site.base_path, "content")):
+        if not self.site.source.exists(os.path.join(self.site.base_path, "content")):
             if len(self.site.files) == 0:
                 logging.info("no files found for %s", self.site.base_path)
             else:
@@ -252,7 +250,6 @@ class HTMLExporter:
                                 (self.site.base_path, len(self.site.files)))
             return
 
-        start = "%s/content/sites/%s/files" % (self.site.base_path, self.site.name)
         dst = "%s/files" % self.full_path
 
         if os.path.exists(dst):
@@ -262,7 +259,17 @@ class HTMLExporter:
         logging.debug("Copying files from %s to %s", start, dst)
 
         # copy all files as they are
-        shutil.copytree(start, dst, ignore=HTMLExporter.files_to_ignore)
+        for (path, file_name) in self.site.source.walk_files(start):
+            relative_path = os.path.relpath(os.path.join(path, file_name), start)
+
+            if any(name in self.FILES_TO_IGNORE for name in relative_path.split(os.sep)):
+                continue
+
+            file_dst = os.path.join(dst, relative_path)
+            os.makedirs(os.path.dirname(file_dst), exist_ok=True)
+            copy_file(self.site.source, os.path.join(path, file_name), file_dst)
+
+        self.site.source.close()
 
         # move all files one level up: out of the directory with same name
         for (path, dirs, files) in os.walk(dst):
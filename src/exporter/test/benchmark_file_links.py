@@ -0,0 +1,96 @@
+"""(c) All rights reserved. ECOLE POLYTECHNIQUE FEDERALE DE LAUSANNE, Switzerland, VPSI, 2017
+
+    Micro-benchmark of WPExporter.fix_file_links: the former pass over all the boxes
+    for each imported file, against the single pass once all the files are imported.
+
+    Run from the src directory:
+        `python -m exporter.test.benchmark_file_links [<number of boxes>]`
+"""
+import sys
+import timeit
+
+from exporter.wp_exporter import WPExporter
+from parser.links import rewrite_links
+
+# the former fix is quadratic, it's not run for more files
+MAX_FILES_PER_FILE = 100
+
+
+class FakeBox:
+    def __init__(self, content):
+        self.content = content
+
+
+class FakeSite:
+    def __init__(self, contents):
+        self.boxes = [FakeBox(content) for content in contents]
+
+    def get_all_boxes(self):
+        return self.boxes
+
+
+def make_contents(nb_boxes, nb_files, links_per_box=5):
+    """The HTML of boxes linking to the files, and to a page"""
+    contents = []
+
+    for index in range(nb_boxes):
+        links = ['<a href="/files/doc%s.pdf">doc</a><img src="/files/img%s.png">' % (
+            (index + link) % nb_files, (index + link) % nb_files) for link in range(links_per_box)]
+        contents.append('<p>Box %s</p><a href="/page-%s.html">page</a>%s' % (index, index, "".join(links)))
+
+    return contents
+
+
+def make_file_urls(nb_files):
+    """The wp media source url of each file"""
+    file_urls = {}
+
+    for index in range(nb_files):
+        file_urls["/files/doc%s.pdf" % index] = "http://wp/uploads/doc%s.pdf" % index
+        file_urls["/files/img%s.png" % index] = "http://wp/uploads/img%s.png" % index
+
+    return file_urls
+
+
+def per_file(contents, file_urls):
+    """The former fix: a pass over all the boxes for each imported file"""
+    site = FakeSite(contents)
+
+    for old_url, new_url in file_urls.items():
+        for box in site.get_all_boxes():
+            box.content = rewrite_links(box.content, lambda tag_name, link: new_url if link == old_url else None)
+
+    return [box.content for box in site.boxes]
+
+
+def one_pass(contents, file_urls):
+    """The fix of WPExporter, once all the files are imported"""
+    exporter = WPExporter.__new__(WPExporter)
+    exporter.site = FakeSite(contents)
+    exporter.fix_file_links(file_urls)
+
+    return [box.content for box in exporter.site.boxes]
+
+
+def benchmark(nb_boxes, number=3):
+    for nb_files in [10, 100, 500, 2000]:
+        contents = make_contents(nb_boxes, nb_files)
+        file_urls = make_file_urls(nb_files)
+
+        one = timeit.timeit(lambda: one_pass(contents, file_urls), number=number) / number
+
+        if nb_files <= MAX_FILES_PER_FILE:
+            start_time = timeit.default_timer()
+            fixed_contents = per_file(contents, file_urls)
+            former = timeit.default_timer() - start_time
+
+            assert fixed_contents == one_pass(contents, file_urls)
+
+            print("%s boxes, %s files: per file %.2f s, one pass %.3f s (x%.0f)" % (
+                nb_boxes, nb_files, former, one, former / one))
+        else:
+            print("%s boxes, %s files: one pass %.3f s" % (nb_boxes, nb_files, one))
+
+
+if __name__ == '__main__':
+    benchmark(int(sys.argv[1]) if len(sys.argv) > 1 else 1000)
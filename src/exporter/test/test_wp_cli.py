@@ -0,0 +1,93 @@
+"""(c) All rights reserved. ECOLE POLYTECHNIQUE FEDERALE DE LAUSANNE, Switzerland, VPSI, 2017
+
+    Testing the WP-CLI worker, with a fake docker running a fake worker script
+"""
+import subprocess
+import sys
+
+import pytest
+
+from exporter.wp_cli import WPCliWorker, WPCliWorkerError, WPCliWorkerStartError
+
+# the fake 'docker exec' of the worker script: it echoes the commands, except
+# 'fail' which fails and 'crash' which stops the worker
+DOCKER = """#!%s
+import json
+import sys
+
+args = sys.argv[1:]
+
+# copy of the worker script
+if "sh" in args:
+    sys.stdin.read()
+    sys.exit(0)
+
+# WordPress can't be loaded
+if "broken" in args:
+    sys.exit(1)
+
+marker = args[-1]
+print("loading WordPress")
+print(marker + " ready", flush=True)
+
+for line in sys.stdin:
+    command = json.loads(line)
+
+    if command[0] == "crash":
+        print("partial output", flush=True)
+        sys.exit(255)
+
+    print(" ".join(command))
+    print("\\n%%s %%s" %% (marker, 1 if command[0] == "fail" else 0), flush=True)
+""" % sys.executable
+
+
+@pytest.fixture()
+def worker(tmpdir, monkeypatch):
+    docker = tmpdir.join("docker")
+    docker.write(DOCKER)
+    docker.chmod(0o755)
+    monkeypatch.setenv("PATH", str(tmpdir), prepend=":")
+
+    worker = WPCliWorker("wp-cli", "/srv/demo")
+    yield worker
+    worker.close()
+
+
+def test_run(worker):
+    assert worker.run("post list --format=ids") == b"post list --format=ids\n"
+    process = worker.process
+
+    # the commands are split like the shell does
+    assert worker.run("option update blogname 'My site'") == b"option update blogname My site\n"
+    assert worker.process is process
+
+
+def test_failed_command(worker):
+    with pytest.raises(subprocess.CalledProcessError) as error:
+        worker.run("fail now")
+    assert error.value.returncode == 1
+    assert error.value.output == b"fail now\n"
+
+    # the worker is still running
+    process = worker.process
+    assert worker.run("post list") == b"post list\n"
+    assert worker.process is process
+
+
+def test_stopped(worker):
+    with pytest.raises(WPCliWorkerError) as error:
+        worker.run("crash")
+    assert not isinstance(error.value, WPCliWorkerStartError)
+    assert worker.process is None
+
+    # started again by the next command
+    assert worker.run("post list") == b"post list\n"
+
+
+def test_start_failure(worker):
+    worker.container = "broken"
+
+    with pytest.raises(WPCliWorkerStartError):
+        worker.run("post list")
+    assert worker.process is None
@@ -0,0 +1,125 @@
+"""(c) All rights reserved. ECOLE POLYTECHNIQUE FEDERALE DE LAUSANNE, Switzerland, VPSI, 2017"""
+import json
+import logging
+import os
+import shlex
+import subprocess
+import uuid
+
+
+class WPCliWorkerError(Exception):
+    """The WP-CLI worker process stopped, the command may have been run or not"""
+    pass
+
+
+class WPCliWorkerStartError(WPCliWorkerError):
+    """The WP-CLI worker process could not be started, the command was not run"""
+    pass
+
+
+class WPCliWorker:
+    """
+    A WP-CLI process running the commands one after the other, in the docker container
+    of WP-CLI. WordPress is loaded once for all the commands, instead of once per
+    'docker exec ... wp' command. See wp_cli_worker.php
+
+    The commands are split like the shell does, so they are written the same way
+    as for 'docker exec <container> sh -c "wp <command>"'. The commands reading
+    STDIN (e.g. --stdin) can't be run by the worker.
+    """
+
+    SCRIPT = os.path.join(os.path.dirname(__file__), "wp_cli_worker.php")
+
+    # where the script is copied in the container
+    CONTAINER_SCRIPT = "/tmp/wp_cli_worker.php"
+
+    def __init__(self, container, path):
+        self.container = container
+        self.path = path
+        self.process = None
+        # the line following the output of each command
+        self.marker = None
+
+    def start(self):
+        """Copy the worker script in the container, and start it once WordPress is loaded"""
+        logging.debug("Starting the WP-CLI worker in %s", self.container)
+
+        try:
+            with open(self.SCRIPT, 'rb') as script:
+                subprocess.run(
+                    ["docker", "exec", "-i", self.container, "sh", "-c", "cat > %s" % self.CONTAINER_SCRIPT],
+                    stdin=script, check=True)
+
+            self.marker = "wp-cli-worker-%s" % uuid.uuid4().hex
+            self.process = subprocess.Popen(
+                ["docker", "exec", "-i", self.container, "wp", "--allow-root", "--path=%s" % self.path,
+                 "eval-file", self.CONTAINER_SCRIPT, self.marker],
+                stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+
+            # the output of WordPress while loading, if any, is skipped
+            ready = self.marker.encode("utf-8") + b" ready\n"
+            while True:
+                line = self.process.stdout.readline()
+
+                if not line:
+                    raise EOFError("no output")
+
+                if line == ready:
+                    break
+        except (OSError, EOFError, subprocess.CalledProcessError) as err:
+            self.close()
+            raise WPCliWorkerStartError("Could not start the WP-CLI worker: %s" % err)
+
+    def run(self, command):
+        """
+        Returns the output of the given WP-CLI command (without 'wp'), as bytes.
+        Raises CalledProcessError if the command failed, WPCliWorkerStartError if
+        the worker could not be started and WPCliWorkerError if it stopped
+        """
+        if self.process is None:
+            self.start()
+
+        marker = self.marker.encode("utf-8") + b" "
+        output = []
+
+        try:
+            self.process.stdin.write(json.dumps(shlex.split(command)).encode("utf-8") + b"\n")
+            self.process.stdin.flush()
+
+            while True:
+                line = self.process.stdout.readline()
+
+                if not line:
+                    raise EOFError("no output")
+
+                if line.startswith(marker):
+                    return_code = int(line[len(marker):])
+                    break
+
+                output.append(line)
+        except (OSError, EOFError) as err:
+            self.close()
+            raise WPCliWorkerError("The WP-CLI worker stopped running '%s': %s" % (command, err))
+
+        # without the line break before the marker
+        output = b"".join(output)[:-1]
+
+        if return_code != 0:
+            raise subprocess.CalledProcessError(return_code, command, output)
+
+        return output
+
+    def close(self):
+        """Stop the worker, it's started again by the next command"""
+        if self.process is None:
+            return
+
+        try:
+            self.process.stdin.close()
+        except OSError:
+            pass
+
+        self.process.stdout.close()
+
+        self.process.wait()
+        self.process = None
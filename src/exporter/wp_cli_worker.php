@@ -0,0 +1,43 @@
+<?php
+/**
+ * (c) All rights reserved. ECOLE POLYTECHNIQUE FEDERALE DE LAUSANNE, Switzerland, VPSI, 2017
+ *
+ * Runs WP-CLI commands one after the other in the same WordPress, so that it's loaded
+ * only once. Started by exporter/wp_cli.py with:
+ *
+ *     wp eval-file wp_cli_worker.php <marker>
+ *
+ * Once WordPress is loaded, it writes a line "<marker> ready". Then each line of
+ * STDIN is a command, as a JSON array of arguments, e.g.
+ * ["menu", "item", "add-post", "main", "12", "--porcelain"]. The output of the
+ * command is followed by a line "<marker> <return code>".
+ */
+
+$marker = $args[0];
+
+// WP_CLI::error() and WP_CLI::halt() throw an ExitException instead of exiting
+$capture_exit = new ReflectionProperty( 'WP_CLI', 'capture_exit' );
+$capture_exit->setAccessible( true );
+$capture_exit->setValue( null, true );
+
+fwrite( STDOUT, $marker . " ready\n" );
+fflush( STDOUT );
+
+while ( ( $line = fgets( STDIN ) ) !== false ) {
+    $arguments = json_decode( $line, true );
+
+    // each command sees what the previous ones changed, e.g. with update_option
+    wp_cache_flush();
+
+    list( $positional_args, $assoc_args ) = \WP_CLI\Configurator::extract_assoc( $arguments );
+
+    try {
+        WP_CLI::run_command( $positional_args, $assoc_args );
+        $return_code = 0;
+    } catch ( \WP_CLI\ExitException $e ) {
+        $return_code = $e->getCode();
+    }
+
+    fwrite( STDOUT, "\n" . $marker . " " . $return_code . "\n" );
+    fflush( STDOUT );
+}
@@ -5,13 +5,16 @@ import subprocess
 import timeit
 from collections import OrderedDict
 from datetime import timedelta, datetime
+from multiprocessing.pool import ThreadPool
 
 import simplejson
-from bs4 import BeautifulSoup
 from wordpress_json import WordpressJsonWrapper, WordpressError
 
 from exporter.utils import Utils
-from settings import WP_SUPERADMIN_USER, WP_SUPERADMIN_PASSWORD, WP_PATH, CONFIGURED_LANGUAGES
+from exporter.wp_cli import WPCliWorker, WPCliWorkerError, WPCliWorkerStartError
+from parser.links import rewrite_links
+from settings import WP_SUPERADMIN_USER, WP_SUPERADMIN_PASSWORD, WP_PATH, CONFIGURED_LANGUAGES, WP_API_WORKERS, \
+    WP_CLI_WORKER
 
 
 class WPExporter:
@@ -44,6 +47,9 @@ class WPExporter:
         # dictionary with the key 'wp_page_id' and the value 'wp_menu_id'
         self.menu_id_dict = {}
         self.cli_container = wp_cli or "wp-cli-%s" % self.site.name
+        self.cli_worker = WPCliWorker(self.cli_container, self.path) if WP_CLI_WORKER else None
+        # the (number of calls, total time, max time) of the WP-CLI commands, see wp_cli
+        self.cli_latencies = {}
         self.output_dir = output_dir
 
         # we use the python-wordpress-json library to interact with the wordpress REST API
@@ -55,9 +61,25 @@ class WPExporter:
         """
         Wrapper around the WP-CLI (wp-cli.org),
         official wordpress command line interface)
-        available in the docker container wpcli
+        available in the docker container wpcli.
+
+        The commands are run by a WPCliWorker, except the ones reading stdin.
+        They are run one by one with 'docker exec' if the worker can't be started
         """
+        start_time = timeit.default_timer()
+
         try:
+            if self.cli_worker and not stdin:
+                try:
+                    return self.cli_worker.run(command)
+                except WPCliWorkerStartError as err:
+                    logging.warning("%s - WP export - %s, running the commands one by one", self.site.name, err)
+                    self.cli_worker = None
+                except WPCliWorkerError as err:
+                    # the command may have been run, it's not run again
+                    logging.error("%s - WP export - wp_cli failed : %s", self.site.name, err)
+                    return None
+
             cmd = "docker exec %s" % self.cli_container
 
             if stdin:
@@ -72,6 +94,23 @@ class WPExporter:
         except subprocess.CalledProcessError as err:
             logging.error("%s - WP export - wp_cli failed : %s", self.site.name, err)
             return None
+        finally:
+            # the latencies by command, e.g. "menu item add-post"
+            name = " ".join([arg for arg in command.split()[:3] if not arg.startswith("-")])
+            count, total, maximum = self.cli_latencies.get(name, (0, 0, 0))
+            elapsed = timeit.default_timer() - start_time
+            self.cli_latencies[name] = (count + 1, total + elapsed, max(maximum, elapsed))
+
+    def close_wp_cli(self):
+        """Stop the WP-CLI worker, and log the latency of the WP-CLI commands"""
+        if self.cli_worker:
+            self.cli_worker.close()
+
+        for name, (count, total, maximum) in sorted(self.cli_latencies.items()):
+            logging.info("wp %s: %s calls, %.0f ms on average, %.0f ms max",
+                         name, count, total * 1000 / count, maximum * 1000)
+
+        self.cli_latencies = {}
 
     def import_all_data_to_wordpress(self):
         """
@@ -110,6 +149,8 @@ class WPExporter:
             with open(tracer_path, 'a', newline='\n') as tracer:
                 tracer.write("%s, ERROR %s\n" % (self.site.name, str(err)))
                 tracer.flush()
+        finally:
+            self.close_wp_cli()
 
     def align_languages(self):
         """
@@ -126,11 +167,19 @@ class WPExporter:
         Import medias to Wordpress
         """
         logging.info("{0:%Y-%m-%d %H:%M:%S} WP medias import start".format(datetime.now()))
+
+        # the wp media source url of each file relative path
+        file_urls = {}
+
         for file in self.site.files:
             wp_media = self.import_media(file)
             if wp_media:
-                self.fix_file_links(file, wp_media)
+                if "/files" in file.path:
+                    file_urls.setdefault(file.path[file.path.rfind("/files"):], wp_media['source_url'])
                 self.report['files'] += 1
+
+        # fix the links once all the medias are uploaded
+        self.fix_file_links(file_urls)
         logging.info("{0:%Y-%m-%d %H:%M:%S} WP medias imported".format(datetime.now()))
 
     def import_media(self, media):
@@ -138,7 +187,7 @@ class WPExporter:
         Import a media to Wordpress
         """
         file_path = media.path + '/' + media.name
-        file = open(file_path, 'rb')
+        file = self.site.source.open(file_path)
 
         files = {
             'file': file
@@ -169,87 +218,35 @@ class WPExporter:
             logging.error("%s - WP export - media failed: %s", self.site.name, e)
             self.report['failed_files'] += 1
 
-    def fix_file_links(self, file, wp_media):
-        """Fix the links pointing to the given file"""
-
-        if "/files" not in file.path:
+    def fix_file_links(self, file_urls):
+        """
+        Fix the links pointing to the files, in one pass over the boxes.
+        file_urls is the wp media source url of each file relative path
+        """
+        if not file_urls:
             return
 
-        # the old url is the file relative path
-        old_url = file.path[file.path.rfind("/files"):]
-
-        # the new url is the wp media source url
-        new_url = wp_media['source_url']
-
-        tag_attribute_tuples = [("a", "href"), ("img", "src"), ("script", "src")]
-
         for box in self.site.get_all_boxes():
+            box.content = rewrite_links(box.content, lambda tag_name, link: file_urls.get(link))
 
-            soup = BeautifulSoup(box.content, 'html.parser')
-
-            for tag_name, tag_attribute in tag_attribute_tuples:
-
-                self.fix_links_in_tag(
-                    soup=soup,
-                    old_url=old_url,
-                    new_url=new_url,
-                    tag_name=tag_name,
-                    tag_attribute=tag_attribute)
-
-            # save the new box content
-            box.content = str(soup)
-
-    def fix_page_content_links(self, wp_pages):
+    def update_pages(self, updates):
         """
-        Fix all the links once we know all the WordPress pages urls
+        Update the given pages, as (page id, title, content, parent id) tuples, with
+        WP_API_WORKERS threads: the requests are mostly waiting for WordPress
         """
-        for wp_page in wp_pages:
-
-            content = ""
-
-            if "content" in wp_page:
-                content = wp_page["content"]["raw"]
-            else:
-                logging.error("Expected content for page %s" % wp_page)
-
-            soup = BeautifulSoup(content, 'html.parser')
-
-            for url_mapping in self.urls_mapping:
-
-                old_url = url_mapping["jahia_url"]
-                new_url = url_mapping["wp_url"]
-
-                self.fix_links_in_tag(
-                    soup=soup,
-                    old_url=old_url,
-                    new_url=new_url,
-                    tag_name="a",
-                    tag_attribute="href"
-                )
-
-            # update the page
-            wp_id = wp_page["id"]
-
-            content = str(soup)
-
-            self.update_page_content(page_id=wp_id, content=content)
-
-    def fix_links_in_tag(self, soup, old_url, new_url, tag_name, tag_attribute):
-        """Fix the links in the given tag"""
-
-        tags = soup.find_all(tag_name)
+        if not updates:
+            return
 
-        for tag in tags:
-            link = tag.get(tag_attribute)
+        start_time = timeit.default_timer()
+        workers = max(1, min(WP_API_WORKERS, len(updates)))
 
-            if not link:
-                continue
+        with ThreadPool(processes=workers) as pool:
+            pool.starmap(self.update_page, updates)
 
-            if link == old_url:
-                logging.debug("Changing link from %s to %s" % (old_url, new_url))
-                tag[tag_attribute] = new_url
+        logging.info("%s WP pages updated with %s worker(s) in %.2fs",
+                     len(updates), workers, timeit.default_timer() - start_time)
 
-    def update_page(self, page_id, title, content):
+    def update_page(self, page_id, title, content, parent_id=None):
         """
         Import a page to Wordpress
         """
@@ -273,12 +270,10 @@ class WPExporter:
             # categories
             # tags
         }
-        return self.wp.post_pages(page_id=page_id, data=wp_page_info)
+        if parent_id:
+            wp_page_info['parent'] = parent_id
 
-    def update_page_content(self, page_id, content):
-        """Update the page content"""
-        data = {"content": content}
-        return self.wp.post_pages(page_id=page_id, data=data)
+        return self.wp.post_pages(page_id=page_id, data=wp_page_info)
 
     def import_page(self, slug, title, content):
 
@@ -307,24 +302,53 @@ class WPExporter:
 
     def import_pages(self):
         """
-        Import all pages of jahia site to Wordpress
+        Import all pages of jahia site to Wordpress, in two phases so that each page
+        is written once, with its links and its parent:
+
+        1. the pages are created empty, to know their WordPress id and url
+        2. the pages are updated with their title, content and parent
         """
+        self.create_pages()
+
+        # the first mapping of each url wins
+        wp_urls = {}
+        for url_mapping in self.urls_mapping:
+            wp_urls.setdefault(url_mapping["jahia_url"], url_mapping["wp_url"])
 
-        # keep the pages for fixing the links later
-        wp_pages = []
+        # the (page id, title, content, parent id) of the pages
+        updates = []
 
         for page in self.site.pages_by_pid.values():
+            for lang, page_content in page.contents.items():
+                if not page_content.wp_id:
+                    continue
 
-            contents = {}
-            info_page = OrderedDict()
+                content = "".join(box.content for box in page_content.boxes)
 
-            for lang in page.contents.keys():
-                contents[lang] = ""
+                # the links to the other pages
+                content = rewrite_links(content, lambda tag_name, link: wp_urls.get(link),
+                                        link_attributes={"a": "href"})
 
-                # create the page content
-                for box in page.contents[lang].boxes:
-                    contents[lang] += box.content
+                parent_id = None
+                if page.parent and lang in page.parent.contents:
+                    parent_id = page.parent.contents[lang].wp_id
+
+                updates.append((page_content.wp_id, page_content.title, content, parent_id))
 
+        self.update_pages(updates)
+
+        self.create_sitemaps()
+
+    def create_pages(self):
+        """
+        Create the empty pages, all their languages together, and keep their
+        WordPress id and url
+        """
+        for page in self.site.pages_by_pid.values():
+
+            info_page = OrderedDict()
+
+            for lang in page.contents.keys():
                 info_page[lang] = {
                     'post_name': page.contents[lang].path,
                     'post_status': 'publish',
@@ -341,50 +365,48 @@ class WPExporter:
 
             wp_ids = result.decode("utf-8").split()
 
-            if len(wp_ids) != len(contents):
-                error_msg = "%s page created is not expected : %s" % (len(wp_ids), len(contents))
+            if len(wp_ids) != len(info_page):
+                error_msg = "%s page created is not expected : %s" % (len(wp_ids), len(info_page))
                 logging.error(error_msg)
                 continue
 
-            for wp_id, (lang, content) in zip(wp_ids, contents.items()):
-                wp_page = self.update_page(page_id=wp_id, title=page.contents[lang].title, content=content)
-
-                # prepare mapping for the nginx conf generation
-                mapping = {
-                    'jahia_url': page.contents[lang].path,
-                    'wp_url': wp_page['link']
-                }
+            for wp_id, lang in zip(wp_ids, info_page.keys()):
+                # keep WordPress ID for further usages
+                page.contents[lang].wp_id = int(wp_id)
 
-                self.urls_mapping.append(mapping)
+            self.report['pages'] += 1
 
-                logging.info("WP page '%s' created", wp_page['link'])
+        # the urls of all the pages, in one call
+        page_contents = [page_content for page in self.site.pages_by_pid.values()
+                         for page_content in page.contents.values() if page_content.wp_id]
 
-                # keep WordPress ID for further usages
-                page.contents[lang].wp_id = wp_page['id']
+        if not page_contents:
+            return
 
-                wp_pages.append(wp_page)
+        cmd = "post list --post_type=page --post__in=%s --posts_per_page=-1 --lang=%s --fields=ID,url --format=json" % (
+            ",".join(str(page_content.wp_id) for page_content in page_contents), ",".join(self.site.languages))
 
-            self.report['pages'] += 1
+        result = self.wp_cli(command=cmd)
+        if not result:
+            logging.error("%s - WP export - Could not get the pages urls", self.site.name)
+            return
 
-        self.fix_page_content_links(wp_pages)
+        wp_urls = {wp_page['ID']: wp_page['url'] for wp_page in simplejson.loads(result.decode("utf-8"))}
 
-        self.create_sitemaps()
+        for page_content in page_contents:
+            if page_content.wp_id not in wp_urls:
+                logging.error("%s - WP export - No url for page %s", self.site.name, page_content.wp_id)
+                continue
 
-        self.update_parent_ids()
+            # prepare mapping for the nginx conf generation
+            mapping = {
+                'jahia_url': page_content.path,
+                'wp_url': wp_urls[page_content.wp_id]
+            }
 
-    def update_parent_ids(self):
-        """
-        Update all pages to define the pages hierarchy
-        """
-        for page in self.site.pages_by_pid.values():
-            for lang, page_content in page.contents.items():
+            self.urls_mapping.append(mapping)
 
-                if page.parent and page_content.wp_id:
-                    parent_id = page.parent.contents[lang].wp_id
-                    wp_page_info = {
-                        'parent': parent_id
-                    }
-                    self.wp.post_pages(page_id=page.contents[lang].wp_id, data=wp_page_info)
+            logging.info("WP page '%s' created", wp_urls[page_content.wp_id])
 
     def create_sitemaps(self):
 
@@ -544,9 +566,12 @@ class WPExporter:
         """
         Delete all content WordPress
         """
-        self.delete_medias()
-        self.delete_pages()
-        self.delete_widgets()
+        try:
+            self.delete_medias()
+            self.delete_pages()
+            self.delete_widgets()
+        finally:
+            self.close_wp_cli()
 
     def delete_medias(self):
         """
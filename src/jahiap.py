@@ -3,20 +3,26 @@ jahiap: a wonderful tool
 
 Usage:
   jahiap.py crawl <site> [--output-dir=<OUTPUT_DIR>] [--export-path=<EXPORT_PATH>]
-                         [--number=<NUMBER>] [--date DATE] [--force-crawl] [--debug | --quiet]
+                         [--number=<NUMBER>] [--date DATE] [--force-crawl] [--crawl-workers=<CRAWL_WORKERS>]
+                         [--incremental --max-age=<MAX_AGE>] [--debug | --quiet]
   jahiap.py unzip <site> [--output-dir=<OUTPUT_DIR>] [--number=<NUMBER>] [--debug | --quiet]
   jahiap.py parse <site> [--output-dir=<OUTPUT_DIR>] [--number=<NUMBER>] [--print-report]
-                          [--debug | --quiet] [--use-cache] [--site-path=<SITE_PATH>]
+                          [--debug | --quiet] [--use-cache] [--site-path=<SITE_PATH>] [--streaming]
+                          [--parse-workers=<PARSE_WORKERS>] [--jobs=<JOBS>] [--metadata-only | --from-zip]
   jahiap.py export <site> [--clean-wordpress | --to-wordpress | --nginx-conf]
                           [--wp-cli=<WP_CLI> --site-host=<SITE_HOST> --site-path=<SITE_PATH>]
                           [--to-static --to-dictionary --number=<NUMBER> --print-report]
                           [--output-dir=<OUTPUT_DIR> --export-path=<EXPORT_PATH>]
-                          [--use-cache] [--debug | --quiet]
+                          [--use-cache] [--streaming] [--parse-workers=<PARSE_WORKERS>] [--jobs=<JOBS>] [--from-zip]
+                          [--crawl-workers=<CRAWL_WORKERS>] [--pipeline --unzip-jobs=<UNZIP_JOBS>]
+                          [--export-jobs=<EXPORT_JOBS> --queue-size=<QUEUE_SIZE>]
+                          [--incremental --max-age=<MAX_AGE>] [--debug | --quiet]
   jahiap.py docker <site> [--output-dir=<OUTPUT_DIR>] [--number=<NUMBER>] [--debug | --quiet]
   jahiap.py generate <csv_file> [--output-dir=<OUTPUT_DIR>] [--conf-path=<CONF_PATH>]
                                 [--cookie-path=<COOKIE_PATH>] [--processes=<PROCESSES>] [--force] [--debug | --quiet]
   jahiap.py cleanup <csv_file> [--debug | --quiet]
-  jahiap.py global_report <site> [--output-dir=<OUTPUT_DIR>] [--number=<NUMBER>] [--use-cache] [--debug | --quiet]
+  jahiap.py global_report <site> [--output-dir=<OUTPUT_DIR>] [--number=<NUMBER>] [--use-cache] [--streaming]
+                                 [--parse-workers=<PARSE_WORKERS>] [--jobs=<JOBS>] [--from-zip] [--debug | --quiet]
 
 Options:
   -h --help                     Show this screen.
@@ -26,8 +32,21 @@ Options:
   --export-path=<EXPORT_PATH>   (crawl) Directory where Jahia Zip files are stored
   --date DATE                   (crawl) Date and time for the snapshot, e.g : 2017-01-15-23-00.
   --force-crawl                 (crawl) Force download even if existing snapshot for same site [default: False].
-  --use-cache                   (parse) Do not parse if pickle file found with a previous parsing result
+  --crawl-workers=<CRAWL_WORKERS>  (crawl) Number of sites downloaded in parallel [default: 1].
+  --incremental                 (crawl) Keep the snapshots younger than --max-age, download the others again
+                                (unless Jahia answers If-Modified-Since with a 304, which is not confirmed)
+  --max-age=<MAX_AGE>           (crawl) With --incremental, hours during which a snapshot is kept [default: 0].
+  --use-cache                   (parse) Do not parse if the site was already parsed from the same files
   --site-path=<SITE_PATH>       (parse, export) sub dir where to export parsed content
+  --streaming                   (parse) Parse the export files page by page instead of loading them in memory
+  --parse-workers=<PARSE_WORKERS>  (parse) Number of processes parsing the export files, one language each [default: 1].
+  -j --jobs=<JOBS>              (parse) Number of sites unzipped and parsed in parallel [default: 1].
+  --metadata-only               (parse) Only unzip the files needed to parse, the others are listed from the zip
+  --from-zip                    (parse, export) Read the site files straight from the Jahia zip, without unzipping it
+  --pipeline                    (export) Crawl, unzip, parse and export each site as soon as the previous step is done
+  --unzip-jobs=<UNZIP_JOBS>     (export) With --pipeline, number of sites unzipped in parallel [default: 1].
+  --export-jobs=<EXPORT_JOBS>   (export) With --pipeline, number of sites exported in parallel, not to WP [default: 1].
+  --queue-size=<QUEUE_SIZE>     (export) With --pipeline, number of sites waiting between two steps [default: 4].
   -r --print-report             (FIXME) Print report with content.
   --nginx-conf                  (export) Only export pages to WordPress in order to generate nginx conf
   -s --to-static                (export) Export parsed data to static HTML files.
@@ -45,11 +64,12 @@ Options:
 """
 import logging
 import os
-import pickle
 import sys
 import csv
 import timeit
 from collections import OrderedDict
+from functools import partial
+from multiprocessing.pool import Pool
 from datetime import datetime, timedelta
 from pprint import pprint, pformat
 
@@ -58,13 +78,17 @@ from docopt import docopt
 from utils import Utils
 from generator.utils import Utils as UtilsGenerator
 from crawler import SiteCrawler
+from crawler.manifest import Manifest
 from exporter.dict_exporter import DictExporter
 from exporter.html_exporter import HTMLExporter
 from exporter.wp_exporter import WPExporter
 from wordpress_json import WordpressError
 from generator.tree import Tree
-from unzipper.unzip import unzip_one
+from unzipper.unzip import unzip_one, get_unzip_path, get_zip_checksum, read_unzip_marker
 from parser.jahia_site import Site
+from parser.site_source import ZipSource, get_site_source
+from parser.parse_cache import ParseCache
+from pipeline import Pipeline, Stage
 from settings import VERSION, EXPORT_PATH, WP_HOST, WP_PATH, \
     LINE_LENGTH_ON_EXPORT, LINE_LENGTH_ON_PPRINT
 
@@ -110,6 +134,19 @@ def main_crawl(args):
     logging.info("Jahia ZIP {} downloaded in {}".format(site, elapsed))
 
 
+def crawl_site(args, site_name, value=None):
+    """Download the zip of the given site. Returns its path, or None if it failed"""
+    return SiteCrawler.download_one(site_name, args)
+
+
+def unzip_site(args, site_name, zip_file):
+    """Unzip the given site. Returns the path of the site files, or None if it failed"""
+    try:
+        return unzip_one(args['--output-dir'], site_name, zip_file, metadata_only=args['--metadata-only'])
+    except Exception as err:
+        logging.error("%s - unzip - Could not unzip file - Exception: %s", site_name, err)
+
+
 def main_unzip(args):
     # get zip files according to args
     zip_files = SiteCrawler.download(args)
@@ -118,60 +155,149 @@ def main_unzip(args):
     unzipped_files = OrderedDict()
 
     for site_name, zip_file in zip_files.items():
-        try:
-            unzipped_files[site_name] = unzip_one(args['--output-dir'], site_name, zip_file)
-        except Exception as err:
-            logging.error("%s - unzip - Could not unzip file - Exception: %s", site_name, err)
+        site_dir = unzip_site(args, site_name, zip_file)
+
+        if site_dir:
+            unzipped_files[site_name] = site_dir
 
     # return results
     return unzipped_files
 
 
+def open_site_source(args, site_name, zip_file):
+    """
+    Returns the source of the site files: the Jahia zip with --from-zip, the directory
+    where the site is unzipped otherwise. Returns None if it failed
+    """
+    if args['--from-zip']:
+        try:
+            return ZipSource(zip_file, site_name, get_unzip_path(args['--output-dir'], site_name))
+        except Exception as err:
+            logging.error("%s - unzip - Could not open zip file - Exception: %s", site_name, err)
+            return None
+
+    site_dir = unzip_site(args, site_name, zip_file)
+
+    if site_dir:
+        return get_site_source(site_dir, site_name)
+
+
+def parse_site(args, site_name, source):
+    """
+    Parse and save the given site, read from the given source (see open_site_source).
+    Returns the parsed Site, or None if it failed
+    """
+    try:
+        # create subdir in output_dir
+        output_subdir = os.path.join(args['--output-dir'], site_name)
+        os.makedirs(output_subdir, exist_ok=True)
+
+        # where to cache our parsing
+        parse_cache = ParseCache(output_subdir, site_name)
+
+        # FIXME : site-path should be given in exporter, not parser
+        root_path = ""
+        # if args['--site-path']:
+        #   root_path = "/%s/%s" % (args['--site-path'], site_name)
+        #   logging.info("Setting root_path %s", root_path)
+
+        # when using-cache: check if already parsed, from the same files
+        if args['--use-cache']:
+            site = parse_cache.load(source, root_path)
+
+            if site:
+                return site
+
+        logging.info("Parsing Jahia xml files from %s...", source.path)
+        site = Site(source.path, site_name, root_path=root_path, streaming=args['--streaming'],
+                    parse_workers=int(args['--parse-workers']), source=source)
+
+        print(site.report)
+
+        # the incremental crawl asks Jahia for the site only if it was modified since
+        last_update = site.get_last_update()
+        if last_update:
+            set_last_modified(args, site_name, source, last_update)
+
+        # always save the parsed data on disk, so we can use the
+        # cache later if we want
+        parse_cache.save(site)
+
+        # log success
+        logging.info("Site %s successfully parsed" % site_name)
+        return site
+
+    except Exception as err:
+        logging.error("%s - parse - Exception: %s", site_name, err)
+
+
+def set_last_modified(args, site_name, source, last_update):
+    """
+    Record the last modification of the parsed site in the crawler manifest, only if the
+    site was parsed from the snapshot of the manifest: the modification date of another
+    zip (e.g. an older one, or a newer one not downloaded by the crawler) doesn't tell
+    if the snapshot is up to date
+    """
+    if isinstance(source, ZipSource):
+        checksum = get_zip_checksum(source.zip_file, site_name)
+    else:
+        marker = read_unzip_marker(source.path)
+        checksum = marker and marker.get('checksum')
+
+    manifest = Manifest(args['--export-path'], site_name)
+
+    if not manifest.is_snapshot(checksum):
+        logging.info("%s was not parsed from its last snapshot, not recording its last modification", site_name)
+        return
+
+    manifest.set_last_modified(last_update)
+    manifest.save()
+
+
+def parse_site_helper(task):
+    """Unzip and parse a site in a worker process, see main_parse"""
+    args, site_name, zip_file = task
+    source = open_site_source(args, site_name, zip_file)
+
+    if source:
+        return site_name, parse_site(args, site_name, source)
+
+    return site_name, None
+
+
+def disable_parse_workers(args):
+    """The pool processes can't start the parse workers"""
+    if int(args['--parse-workers']) > 1:
+        logging.warning("--parse-workers is ignored with --jobs, each site is parsed in one process")
+        args['--parse-workers'] = 1
+
+
 def main_parse(args):
-    # get list of sites to parse according to args
-    site_dirs = main_unzip(args)
+    # get zip files according to args
+    zip_files = SiteCrawler.download(args)
 
     # to store paths of parsed objects
     parsed_sites = OrderedDict()
 
-    for site_name, site_dir in site_dirs.items():
-        try:
-            # create subdir in output_dir
-            output_subdir = os.path.join(args['--output-dir'], site_name)
-
-            # where to cache our parsing
-            pickle_file = os.path.join(output_subdir, 'parsed_%s.pkl' % site_name)
-
-            # when using-cache: check if already parsed
-            if args['--use-cache']:
-                if os.path.exists(pickle_file):
-                    with open(pickle_file, 'rb') as input:
-                        logging.info("Loaded parsed site from %s" % pickle_file)
-                        parsed_sites[site_name] = pickle.load(input)
-                        continue
-
-            # FIXME : site-path should be given in exporter, not parser
-            root_path = ""
-            # if args['--site-path']:
-            #   root_path = "/%s/%s" % (args['--site-path'], site_name)
-            #   logging.info("Setting root_path %s", root_path)
-            logging.info("Parsing Jahia xml files from %s...", site_dir)
-            site = Site(site_dir, site_name, root_path=root_path)
-
-            print(site.report)
-
-            # always save the parsed data on disk, so we can use the
-            # cache later if we want
-            with open(pickle_file, 'wb') as output:
-                logging.info("Parsed site saved into %s" % pickle_file)
-                pickle.dump(site, output, pickle.HIGHEST_PROTOCOL)
-
-            # log success
-            logging.info("Site %s successfully parsed" % site_name)
-            parsed_sites[site_name] = site
+    # each site is unzipped and parsed independently
+    tasks = [(args, site_name, zip_file) for site_name, zip_file in zip_files.items()]
 
-        except Exception as err:
-            logging.error("%s - parse - Exception: %s", site_name, err)
+    jobs = int(args['--jobs'])
+
+    if jobs > 1 and len(tasks) > 1:
+        disable_parse_workers(args)
+
+        # the sites are added in the order they are parsed
+        with Pool(processes=jobs) as pool:
+            for site_name, site in pool.imap_unordered(parse_site_helper, tasks):
+                if site:
+                    parsed_sites[site_name] = site
+    else:
+        for task in tasks:
+            site_name, site = parse_site_helper(task)
+
+            if site:
+                parsed_sites[site_name] = site
 
     # return results
     return parsed_sites
@@ -183,6 +309,8 @@ def main_global_report(args):
 
     logging.info("Generating global report at %s" % path)
 
+    # the report only needs the number of files, not the files
+    args['--metadata-only'] = True
     sites = main_parse(args)
 
     # retrieve all the box types
@@ -211,104 +339,150 @@ def main_global_report(args):
             writer.writerow(site.get_report_info(box_types))
 
 
-def main_export(args):
-    # get list of parsed sites
-
-    sites = main_parse(args)
-
+def export_site(args, site_name, site):
+    """
+    Export the given parsed site. Returns where it was exported, e.g.
+    {wordpress: URL, static: PATH, dict: PATH}
+    """
     wp_cli = None
     if '--wp-cli' in args:
         wp_cli = args['--wp-cli']
 
+    # store results
+    exported_site = {}
+
+    try:
+        # create subdir in output_dir
+        output_subdir = os.path.join(args['--output-dir'], site.name)
+
+        try:
+            if args['--clean-wordpress']:
+                logging.info("Cleaning WordPress for %s...", site.name)
+                wp_exporter = WPExporter(
+                    site,
+                    site_host=args['--site-host'],
+                    site_path=args['--site-path'],
+                    output_dir=args['--output-dir'],
+                    wp_cli=wp_cli
+                )
+                wp_exporter.delete_all_content()
+                logging.info("Data of WordPress site %s successfully deleted", site.name)
+
+            if args['--to-wordpress']:
+
+                logging.info("Exporting %s to WordPress...", site.name)
+                wp_exporter = WPExporter(
+                    site,
+                    site_host=args['--site-host'],
+                    site_path=args['--site-path'],
+                    output_dir=args['--output-dir'],
+                    wp_cli=wp_cli
+                )
+                wp_exporter.import_all_data_to_wordpress()
+                exported_site['wordpress'] = args['--site-path']
+                logging.info("Site %s successfully exported to WordPress", site.name)
+
+            if args['--nginx-conf']:
+
+                logging.info("Creating nginx conf for %s...", site.name)
+                wp_exporter = WPExporter(
+                    site,
+                    site_host=args['--site-host'],
+                    site_path=args['--site-path'],
+                    output_dir=args['--output-dir'],
+                    wp_cli=wp_cli
+                )
+                wp_exporter.import_all_data_to_wordpress()
+                wp_exporter.generate_nginx_conf_file()
+                exported_site['wordpress'] = args['--site-path']
+                logging.info("Nginx conf for %s successfully generated", site.name)
+        except WordpressError as err:
+            logging.error("%s - WP export - WordPress not available: %s", site.name, err)
+
+        if args['--to-static']:
+            logging.info("Exporting %s to static website...", site.name)
+            export_path = os.path.join(output_subdir, "html")
+            HTMLExporter(site, export_path)
+            exported_site['static'] = export_path
+            logging.info("Site %s successfully exported to static website", site.name)
+
+        if args['--to-dictionary']:
+            logging.info("Exporting %s to python dictionary...", site.name)
+            export_path = os.path.join(
+                output_subdir, "%s_dict.py" % site.name)
+            data = DictExporter.generate_data(site)
+            pprint(data, width=LINE_LENGTH_ON_PPRINT)
+            with open(export_path, 'w') as output:
+                output.write("%s_data = " % site.name)
+                output.write(pformat(data, width=LINE_LENGTH_ON_EXPORT))
+                output.flush()
+            exported_site['dict'] = export_path
+            logging.info("Site %s successfully exported to python dictionary", site.name)
+    except Exception as err:
+        logging.error("%s - export - Error exporting site: %s", site_name, err)
+
+    if args['--to-wordpress'] and int(args['--number']) > 1:
+        wp_exporter = WPExporter(
+            site,
+            site_host=args['--site-host'],
+            site_path=args['--site-path'],
+            output_dir=args['--output-dir'],
+            wp_cli=wp_cli
+        )
+        wp_exporter.delete_all_content()
+        logging.info("Data of Wordpress site successfully deleted")
+
+    return exported_site
+
+
+def export_pipeline(args):
+    """
+    Crawl, unzip, parse and export the sites with a Pipeline: each site goes to
+    the next stage as soon as it's done with the previous one
+    """
+    disable_parse_workers(args)
+
+    export_jobs = int(args['--export-jobs'])
+
+    # the WordPress exports use the same WordPress site
+    if export_jobs > 1 and (args['--to-wordpress'] or args['--clean-wordpress'] or args['--nginx-conf']):
+        logging.warning("--export-jobs is ignored with WordPress, the sites are exported one by one")
+        export_jobs = 1
+
+    # the crawl workers share the HTTP connections of the crawler session
+    crawl_workers = int(args['--crawl-workers'])
+    SiteCrawler.set_pool_size(crawl_workers)
+
+    stages = [
+        Stage("crawl", partial(crawl_site, args), workers=crawl_workers),
+        Stage("unzip", partial(open_site_source, args), workers=int(args['--unzip-jobs'])),
+        Stage("parse", partial(parse_site, args), workers=int(args['--jobs']), processes=True),
+        Stage("export", partial(export_site, args), workers=export_jobs),
+    ]
+
+    pipeline = Pipeline(stages, queue_size=int(args['--queue-size']))
+
     # to store results of exported parsed sites
     exported_sites = OrderedDict()
 
-    for site_name, site in sites.items():
-        try:
+    for site_name, exported_site in pipeline.run((site_name, None) for site_name in SiteCrawler.get_sites(args)):
+        exported_sites[site_name] = exported_site
 
-            # store results
-            exported_site = {}
-            exported_sites[site_name] = exported_site
-
-            # create subdir in output_dir
-            output_subdir = os.path.join(args['--output-dir'], site.name)
-
-            try:
-                if args['--clean-wordpress']:
-                    logging.info("Cleaning WordPress for %s...", site.name)
-                    wp_exporter = WPExporter(
-                        site,
-                        site_host=args['--site-host'],
-                        site_path=args['--site-path'],
-                        output_dir=args['--output-dir'],
-                        wp_cli=wp_cli
-                    )
-                    wp_exporter.delete_all_content()
-                    logging.info("Data of WordPress site %s successfully deleted", site.name)
-
-                if args['--to-wordpress']:
-
-                    logging.info("Exporting %s to WordPress...", site.name)
-                    wp_exporter = WPExporter(
-                        site,
-                        site_host=args['--site-host'],
-                        site_path=args['--site-path'],
-                        output_dir=args['--output-dir'],
-                        wp_cli=wp_cli
-                    )
-                    wp_exporter.import_all_data_to_wordpress()
-                    exported_site['wordpress'] = args['--site-path']
-                    logging.info("Site %s successfully exported to WordPress", site.name)
-
-                if args['--nginx-conf']:
-
-                    logging.info("Creating nginx conf for %s...", site.name)
-                    wp_exporter = WPExporter(
-                        site,
-                        site_host=args['--site-host'],
-                        site_path=args['--site-path'],
-                        output_dir=args['--output-dir'],
-                        wp_cli=wp_cli
-                    )
-                    wp_exporter.import_all_data_to_wordpress()
-                    wp_exporter.generate_nginx_conf_file()
-                    exported_site['wordpress'] = args['--site-path']
-                    logging.info("Nginx conf for %s successfully generated", site.name)
-            except WordpressError as err:
-                logging.error("%s - WP export - WordPress not available: %s", site.name, err)
-
-            if args['--to-static']:
-                logging.info("Exporting %s to static website...", site.name)
-                export_path = os.path.join(output_subdir, "html")
-                HTMLExporter(site, export_path)
-                exported_site['static'] = export_path
-                logging.info("Site %s successfully exported to static website", site.name)
-
-            if args['--to-dictionary']:
-                logging.info("Exporting %s to python dictionary...", site.name)
-                export_path = os.path.join(
-                    output_subdir, "%s_dict.py" % site.name)
-                data = DictExporter.generate_data(site)
-                pprint(data, width=LINE_LENGTH_ON_PPRINT)
-                with open(export_path, 'w') as output:
-                    output.write("%s_data = " % site.name)
-                    output.write(pformat(data, width=LINE_LENGTH_ON_EXPORT))
-                    output.flush()
-                exported_site['dict'] = export_path
-                logging.info("Site %s successfully exported to python dictionary", site.name)
-        except Exception as err:
-            logging.error("%s - export - Error exporting site: %s", site_name, err)
-
-        if args['--to-wordpress'] and int(args['--number']) > 1:
-            wp_exporter = WPExporter(
-                site,
-                site_host=args['--site-host'],
-                site_path=args['--site-path'],
-                output_dir=args['--output-dir'],
-                wp_cli=wp_cli
-            )
-            wp_exporter.delete_all_content()
-            logging.info("Data of Wordpress site successfully deleted")
+    return exported_sites
+
+
+def main_export(args):
+    if args['--pipeline']:
+        return export_pipeline(args)
+
+    # get list of parsed sites
+    sites = main_parse(args)
+
+    # to store results of exported parsed sites
+    exported_sites = OrderedDict()
+
+    for site_name, site in sites.items():
+        exported_sites[site_name] = export_site(args, site_name, site)
 
     # overall result : {site_name: {wordpress: URL, static: PATH, dict: PATH}, ...}
     return exported_sites
@@ -0,0 +1,302 @@
+"""(c) All rights reserved. ECOLE POLYTECHNIQUE FEDERALE DE LAUSANNE, Switzerland, VPSI, 2017"""
+
+import os
+import pickle
+
+from parser.box import Box
+from parser.file import File
+from parser.page import Page
+from parser.page_content import PageContent
+from parser.sidebar import Sidebar
+
+"""
+    A columnar format for the parsed Site, used by the parse cache.
+
+    Instead of pickling the graph of objects, with the back-references of each object,
+    the Pages, PageContents, Sidebars, Boxes and Files are saved as tables: one list
+    per attribute (a column), the references being the indexes in the other tables
+    and the strings being the indexes in a table of strings.
+
+    Each table is pickled in its own section, after an index of the sections, so that
+    they can be read separately: the Site is loaded with its own attributes only (e.g.
+    the number of pages and boxes for the reports), and its pages are loaded when
+    first used (see Site.__getattr__).
+"""
+
+# the attributes of the Site that are saved in tables, and loaded when first used
+LAZY_ATTRIBUTES = ("pages_by_pid", "pages_by_uuid", "pages_content_by_path", "homepage", "files")
+
+# the Site attributes that are not saved
+TRANSIENT_ATTRIBUTES = ("source", "lazy_loader")
+
+# the columns of each table, with their type: "string", "ref" (index in another table),
+# "refs" (list of indexes) or "raw" (pickled as is). The other attributes of the
+# objects (e.g. Box.question) are saved as raw values in an 'extra' column
+TABLES = (
+    ("pages", Page, (
+        ("pid", "string"), ("uuid", "string"), ("template", "string"), ("level", "raw"),
+        ("parent", "ref"), ("children", "refs"), ("contents", "raw"))),
+    ("page_contents", PageContent, (
+        ("page", "ref"), ("language", "string"), ("path", "string"), ("title", "string"),
+        ("wp_id", "raw"), ("last_update", "raw"), ("boxes", "refs"), ("sidebar", "ref"))),
+    ("sidebars", Sidebar, (
+        ("boxes", "refs"),)),
+    ("boxes", Box, (
+        ("page_content", "ref"), ("type", "string"), ("title", "string"), ("content", "string"))),
+    ("files", File, (
+        ("name", "string"), ("path", "string"))),
+)
+
+# set again when the objects are loaded
+BACK_REFERENCES = ("site",)
+
+
+class StringTable(object):
+    """The strings of the columns, each one saved once"""
+
+    def __init__(self):
+        self.strings = []
+        self.ids = {}
+
+    def get_id(self, string):
+        string_id = self.ids.get(string)
+
+        if string_id is None:
+            string_id = self.ids[string] = len(self.strings)
+            self.strings.append(string)
+
+        return string_id
+
+
+class ObjectTable(object):
+    """The objects of a table, indexed by identity in the order they are added"""
+
+    def __init__(self):
+        self.objects = []
+        self.ids = {}
+
+    def add(self, obj):
+        if obj is not None and id(obj) not in self.ids:
+            self.ids[id(obj)] = len(self.objects)
+            self.objects.append(obj)
+
+    def get_id(self, obj):
+        return -1 if obj is None else self.ids[id(obj)]
+
+
+def collect_objects(site):
+    """Returns the ObjectTable of each table, with all the objects of the Site"""
+    tables = {name: ObjectTable() for name, cls, columns in TABLES}
+
+    for page in site.pages_by_pid.values():
+        tables["pages"].add(page)
+
+    page_contents = [page_content for page in site.pages_by_pid.values() for page_content in page.contents.values()]
+    page_contents.extend(site.pages_content_by_path.values())
+
+    # the boxes can belong to other PageContents, e.g. in the inherited sidebars
+    while page_contents:
+        page_content = page_contents.pop(0)
+
+        if id(page_content) in tables["page_contents"].ids:
+            continue
+
+        tables["page_contents"].add(page_content)
+        tables["sidebars"].add(page_content.sidebar)
+
+        for box in page_content.boxes + page_content.sidebar.boxes:
+            tables["boxes"].add(box)
+            page_contents.append(box.page_content)
+
+    for file in site.files:
+        tables["files"].add(file)
+
+    return tables
+
+
+def dump_site(site, output):
+    """Write the given Site in the given binary file"""
+    tables = collect_objects(site)
+    strings = StringTable()
+    sections = []
+
+    site_attributes = {key: value for key, value in site.__dict__.items()
+                       if key not in LAZY_ATTRIBUTES + TRANSIENT_ATTRIBUTES}
+    sections.append(("site", site_attributes))
+
+    for name, cls, columns in TABLES:
+        objects = tables[name].objects
+        table = {}
+        known = set(BACK_REFERENCES)
+
+        for column, column_type in columns:
+            known.add(column)
+            values = [getattr(obj, column) for obj in objects]
+
+            if column_type == "string":
+                table[column] = [strings.get_id(value) for value in values]
+            elif column_type == "ref":
+                referenced = tables[get_referenced_table(name, column)]
+                table[column] = [referenced.get_id(value) for value in values]
+            elif column_type == "refs":
+                referenced = tables[get_referenced_table(name, column)]
+                table[column] = [[referenced.get_id(value) for value in value_list] for value_list in values]
+            else:
+                table[column] = values
+
+        # the contents of the pages, by language
+        if name == "pages":
+            table["contents"] = [[(strings.get_id(language), tables["page_contents"].get_id(page_content))
+                                  for language, page_content in contents.items()] for contents in table["contents"]]
+
+        # the other attributes, as {attribute: {index: value}}
+        extra = {}
+        for index, obj in enumerate(objects):
+            for key, value in obj.__dict__.items():
+                if key not in known:
+                    extra.setdefault(key, {})[index] = value
+        table["extra"] = extra
+
+        sections.append((name, table))
+
+    sections.append(("index", {
+        "pages_by_uuid": [(strings.get_id(uuid), tables["pages"].get_id(page))
+                          for uuid, page in site.pages_by_uuid.items()],
+        "pages_content_by_path": [(strings.get_id(path), tables["page_contents"].get_id(page_content))
+                                  for path, page_content in site.pages_content_by_path.items()],
+        "homepage": tables["pages"].get_id(site.homepage),
+    }))
+    sections.append(("strings", strings.strings))
+
+    # the index of the sections: {name: (offset, size)}, from the end of the index
+    blobs = [(name, pickle.dumps(section, pickle.HIGHEST_PROTOCOL)) for name, section in sections]
+    index = {}
+    offset = 0
+
+    for name, blob in blobs:
+        index[name] = (offset, len(blob))
+        offset += len(blob)
+
+    pickle.dump(index, output, pickle.HIGHEST_PROTOCOL)
+
+    for name, blob in blobs:
+        output.write(blob)
+
+
+def get_referenced_table(name, column):
+    """Returns the table referenced by the given column"""
+    if column in ("page", "parent", "children"):
+        return "pages"
+    if column == "page_content":
+        return "page_contents"
+    if column == "sidebar":
+        return "sidebars"
+    return "boxes"
+
+
+class LazyLoader(object):
+    """Loads the tables of a Site when first used, see Site.__getattr__"""
+
+    def __init__(self, path, index, data_offset, fingerprint):
+        self.path = path
+        self.index = index
+        self.data_offset = data_offset
+        # the size and modification time of the file, which can be replaced in the meantime
+        self.fingerprint = fingerprint
+
+    @staticmethod
+    def get_fingerprint(input):
+        """Returns the fingerprint of the given open file"""
+        stat = os.fstat(input.fileno())
+        return stat.st_size, stat.st_mtime_ns
+
+    def read_sections(self, names, input=None):
+        """Returns the given sections, as a dict"""
+        if input is None:
+            with open(self.path, 'rb') as input:
+                if self.get_fingerprint(input) != self.fingerprint:
+                    raise IOError("%s changed since the site was loaded" % self.path)
+
+                return self.read_sections(names, input)
+
+        sections = {}
+
+        for name in names:
+            offset, size = self.index[name]
+            input.seek(self.data_offset + offset)
+            sections[name] = pickle.loads(input.read(size))
+
+        return sections
+
+    def load(self, site):
+        """Set the LAZY_ATTRIBUTES of the given Site"""
+        sections = self.read_sections([name for name, cls, columns in TABLES] + ["index", "strings"])
+        strings = sections["strings"]
+
+        # create the objects first, they reference each other
+        objects = {name: [cls.__new__(cls) for _ in range(len(sections[name][columns[0][0]]))]
+                   for name, cls, columns in TABLES}
+
+        for name, cls, columns in TABLES:
+            table = sections[name]
+            attributes = [{} for _ in objects[name]]
+
+            for column, column_type in columns:
+                if column_type == "string":
+                    values = [strings[value] for value in table[column]]
+                elif column_type == "ref":
+                    referenced = objects[get_referenced_table(name, column)]
+                    values = [None if value < 0 else referenced[value] for value in table[column]]
+                elif column_type == "refs":
+                    referenced = objects[get_referenced_table(name, column)]
+                    values = [[referenced[value] for value in value_list] for value_list in table[column]]
+                else:
+                    values = table[column]
+
+                for obj_attributes, value in zip(attributes, values):
+                    obj_attributes[column] = value
+
+            if name == "pages":
+                page_contents = objects["page_contents"]
+                for obj_attributes in attributes:
+                    obj_attributes["contents"] = {strings[language]: page_contents[page_content]
+                                                  for language, page_content in obj_attributes["contents"]}
+
+            for key, values in table["extra"].items():
+                for index, value in values.items():
+                    attributes[index][key] = value
+
+            for obj, obj_attributes in zip(objects[name], attributes):
+                if cls is not Sidebar and cls is not File:
+                    obj_attributes["site"] = site
+                obj.__dict__.update(obj_attributes)
+
+        index = sections["index"]
+        pages = objects["pages"]
+        page_contents = objects["page_contents"]
+
+        site.pages_by_pid = {page.pid: page for page in pages}
+        site.pages_by_uuid = {strings[uuid]: pages[page] for uuid, page in index["pages_by_uuid"]}
+        site.pages_content_by_path = {strings[path]: page_contents[page_content]
+                                      for path, page_content in index["pages_content_by_path"]}
+        site.homepage = None if index["homepage"] < 0 else pages[index["homepage"]]
+        site.files = objects["files"]
+
+
+def load_site(path, input, source):
+    """
+    Returns the Site written by dump_site in the given file, read from the current
+    position of 'input'. Only the Site attributes are loaded, not its tables
+    """
+    # imported here, jahia_site imports the parse cache
+    from parser.jahia_site import Site
+
+    index = pickle.load(input)
+    loader = LazyLoader(path, index, input.tell(), LazyLoader.get_fingerprint(input))
+
+    site = Site.__new__(Site)
+    site.__dict__.update(loader.read_sections(["site"], input)["site"])
+    site.source = source
+    site.lazy_loader = loader
+
+    return site
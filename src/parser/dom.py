@@ -0,0 +1,284 @@
+"""(c) All rights reserved. ECOLE POLYTECHNIQUE FEDERALE DE LAUSANNE, Switzerland, VPSI, 2017"""
+import io
+import logging
+from collections import defaultdict
+
+from bs4 import BeautifulSoup
+from lxml import etree
+
+"""
+DOM backend for the Jahia export files.
+
+The XML files are parsed only once, with the recovering parser of lxml. The elements
+expose the small subset of the xml.dom.minidom API used by the parser (getAttribute,
+getElementsByTagName, childNodes, parentNode, nodeName...), so Site, Page, PageContent
+and Box work with both.
+"""
+
+# the names of the backends, as reported by Document.backend
+BACKEND_LXML = "lxml"
+BACKEND_BEAUTIFULSOUP = "beautifulsoup"
+BACKEND_LXML_STREAMING = "lxml-iterparse"
+
+# the events yielded by iterparse_pages
+PAGE_START = "start"
+PAGE_END = "end"
+ELEMENT = "element"
+
+# the xml.dom.minidom attribute normalization turns those characters into spaces.
+# We keep the same values as the former BeautifulSoup -> minidom parsing
+WHITESPACES = str.maketrans("\n\r\t", "   ")
+
+
+def qualified_name(element, name):
+    """
+    Return the lxml name ("{uri}local") of the given prefixed name (e.g. "jahia:page"),
+    according to the namespaces declared for the given element
+    """
+    if ":" not in name:
+        return name
+
+    prefix, local_name = name.split(":", 1)
+    uri = element.nsmap.get(prefix)
+
+    # undeclared prefixes are kept as is by the recovering parser
+    if uri is None:
+        return name
+
+    return "{%s}%s" % (uri, local_name)
+
+
+class Element(etree.ElementBase):
+    """An lxml element with the minidom API used by the parser"""
+
+    ELEMENT_NODE = 1
+    nodeType = ELEMENT_NODE
+
+    def __bool__(self):
+        # like minidom nodes, an element without children is still True
+        return True
+
+    @property
+    def nodeName(self):
+        """The prefixed tag name, e.g. "jahia:page" """
+        if self.prefix:
+            return "%s:%s" % (self.prefix, etree.QName(self).localname)
+
+        return self.tag
+
+    @property
+    def parentNode(self):
+        return self.getparent()
+
+    @property
+    def childNodes(self):
+        """The element children, without the comments and processing instructions"""
+        return list(self.iterchildren(tag=etree.Element))
+
+    @property
+    def firstChild(self):
+        for child in self.iterchildren(tag=etree.Element):
+            return child
+
+    def getAttribute(self, name):
+        """Returns the given attribute, or an empty string"""
+        value = self.get(qualified_name(self, name), "")
+
+        if "\n" in value or "\r" in value or "\t" in value:
+            value = value.replace("\r\n", " ").translate(WHITESPACES)
+
+        return value
+
+    def getElementsByTagName(self, name):
+        """Returns all the descendants with the given tag name, in document order"""
+        return list(self.iterdescendants(qualified_name(self, name)))
+
+    def get_first_element_by_tag_name(self, name):
+        """Returns the first descendant with the given tag name, or None"""
+        for element in self.iterdescendants(qualified_name(self, name)):
+            return element
+
+
+class DomIndex:
+    """
+    Index of the elements of a document, built in one pass. For each element, we
+    record its tag and the jahia:page that owns it, i.e. its nearest jahia:page
+    ancestor, so that the parser never walks the whole tree again
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self.page_tag = qualified_name(root, "jahia:page")
+        pid_attribute = qualified_name(root, "jahia:pid")
+
+        # the elements by tag, in document order
+        self.elements_by_tag = defaultdict(list)
+        # the jahia:page elements by pid
+        self.pages_by_pid = {}
+        # the elements owned by each jahia:page. The dict key is the page element,
+        # the dict value is a dict of the elements by tag, in document order
+        self.page_elements = {}
+        # the pid of the page owning each jahia:page, None for the top page.
+        # The dict key is the page element
+        self.parent_pids = {}
+
+        # the jahia:page elements being walked
+        pages = []
+
+        for event, element in etree.iterwalk(root, events=("start", "end")):
+            if event == "end":
+                if element.tag == self.page_tag:
+                    pages.pop()
+                continue
+
+            self.elements_by_tag[element.tag].append(element)
+
+            if pages:
+                self.page_elements[pages[-1]][element.tag].append(element)
+
+            if element.tag == self.page_tag:
+                self.pages_by_pid.setdefault(element.get(pid_attribute, ""), element)
+                self.page_elements[element] = defaultdict(list)
+                self.parent_pids[element] = pages[-1].get(pid_attribute, "") if pages else None
+                pages.append(element)
+
+    def get_elements(self, name):
+        """Returns all the elements with the given tag name, in document order"""
+        return self.elements_by_tag.get(qualified_name(self.root, name), [])
+
+    def get_page_elements(self, page, name):
+        """
+        Returns the elements with the given tag name that belong to the given
+        jahia:page element, without the ones of its sub-pages
+        """
+        return self.page_elements[page].get(qualified_name(self.root, name), [])
+
+    def get_parent_pid(self, page):
+        """Returns the pid of the page owning the given jahia:page element, None for the top page"""
+        return self.parent_pids[page]
+
+    def get_page(self, pid):
+        """Returns the jahia:page element with the given pid, or None"""
+        return self.pages_by_pid.get(pid)
+
+
+class Document:
+    """A parsed Jahia export file"""
+
+    def __init__(self, tree, backend):
+        self.tree = tree
+        self.documentElement = tree.getroot()
+        # the backend that parsed the file (BACKEND_LXML or BACKEND_BEAUTIFULSOUP)
+        self.backend = backend
+        # the DomIndex, built when first used
+        self._index = None
+
+    @property
+    def index(self):
+        if self._index is None:
+            self._index = DomIndex(self.documentElement)
+
+        return self._index
+
+    @property
+    def firstChild(self):
+        return self.documentElement
+
+    def getElementsByTagName(self, name):
+        """Returns all the elements with the given tag name, root included"""
+        return list(self.index.get_elements(name))
+
+    def get_first_element_by_tag_name(self, name):
+        """Returns the first element with the given tag name, or None"""
+        elements = self.index.get_elements(name)
+
+        if elements:
+            return elements[0]
+
+
+def get_parser(recover=True):
+    """Returns an lxml parser building Element instances"""
+    parser = etree.XMLParser(recover=recover, huge_tree=True)
+    parser.set_element_class_lookup(etree.ElementDefaultClassLookup(element=Element))
+    return parser
+
+
+def parse(path, source=None):
+    """
+    Parse the given XML file with the recovering lxml parser. If lxml rejects the file,
+    we fall back on BeautifulSoup, which is slower but more tolerant. The file is read
+    from the given site source if any, see site_source
+    """
+    try:
+        if source:
+            with source.open(path) as xml_file:
+                tree = etree.parse(xml_file, get_parser())
+        else:
+            tree = etree.parse(path, get_parser())
+
+        if tree.getroot() is not None:
+            return Document(tree, BACKEND_LXML)
+
+        logging.warning("lxml found no root element in %s", path)
+    except etree.XMLSyntaxError as err:
+        logging.warning("lxml could not parse %s: %s", path, err)
+
+    with (io.TextIOWrapper(source.open(path)) if source else open(path, "r")) as xml_file:
+        xml_soup = BeautifulSoup(xml_file.read(), 'xml')
+
+    tree = etree.ElementTree(etree.fromstring(str(xml_soup).encode("utf-8"), get_parser(recover=False)))
+
+    return Document(tree, BACKEND_BEAUTIFULSOUP)
+
+
+def iterparse_pages(path, tags=(), source=None):
+    """
+    Stream the jahia:page elements of the given XML file, so that only the current
+    page and its ancestors are kept in memory. Yields (event, element, parent_pid):
+
+      - (PAGE_START, page, parent_pid): only the page attributes are available
+      - (PAGE_END, page, parent_pid): the page content is available, without its
+        sub-pages, that have already been yielded. The page is freed afterwards
+      - (ELEMENT, element, pid): for each element with one of the given tags, pid
+        being the one of the page containing the element
+
+    The parent pid is taken from the stack of the pages being parsed, it is None for
+    the root page. The file is read from the given site source if any.
+    """
+    xml_file = source.open(path) if source else path
+    events = etree.iterparse(xml_file, events=("start", "end"), recover=True, huge_tree=True)
+    events.set_element_class_lookup(etree.ElementDefaultClassLookup(element=Element))
+
+    page_tag = None
+    pids = []
+
+    try:
+        for event, element in events:
+            # the jahia namespace is declared on the root element
+            if page_tag is None:
+                page_tag = qualified_name(element, "jahia:page")
+
+            if element.tag == page_tag:
+                if event == "start":
+                    parent_pid = pids[-1] if pids else None
+                    pids.append(element.get(qualified_name(element, "jahia:pid"), ""))
+
+                    yield PAGE_START, element, parent_pid
+                else:
+                    pids.pop()
+                    parent_pid = pids[-1] if pids else None
+
+                    yield PAGE_END, element, parent_pid
+
+                    # free the page, its parent won't see it anymore
+                    parent = element.getparent()
+                    element.clear()
+                    if parent is not None:
+                        parent.remove(element)
+
+            elif event == "end" and element.tag in tags:
+                yield ELEMENT, element, pids[-1] if pids else None
+    finally:
+        # the file opened by the source
+        if source:
+            xml_file.close()
@@ -1,15 +1,20 @@
 """(c) All rights reserved. ECOLE POLYTECHNIQUE FEDERALE DE LAUSANNE, Switzerland, VPSI, 2017"""
 
+import io
 import os
 import logging
 import collections
+from multiprocessing.pool import Pool
 
-from bs4 import BeautifulSoup
+from parser import dom as jahia_dom
 from parser.box import Box
+from parser.columnar import LAZY_ATTRIBUTES
 from parser.file import File
 from parser.link import Link
+from parser.links import rewrite_links
 from parser.page import Page
 from parser.page_content import PageContent
+from parser.site_source import get_site_source
 from utils import Utils
 
 """
@@ -20,10 +25,23 @@ This file is named jahia_site to avoid a conflict with Site [https://docs.python
 class Site:
     """A Jahia Site. Have 1 to N Pages"""
 
-    def __init__(self, base_path, name, root_path=""):
+    # the elements read when streaming the export files, besides the pages
+    STREAMED_TAGS = ("siteName", "theme", "acronym", "breadCrumbLink", "bottomLinksListList")
+
+    def __init__(self, base_path, name, root_path="", streaming=False, parse_workers=1, language=None, source=None):
         # FIXME: base_path should not depend on output-dir
         self.base_path = base_path
         self.name = name
+        # where the files are read from, by default the directory base_path. See site_source
+        self.source = source or get_site_source(base_path, name)
+        # if True, the export files are streamed page by page instead of
+        # being loaded in memory
+        self.streaming = streaming
+        # the number of processes parsing the export files, one language each
+        self.parse_workers = parse_workers
+        # if set, only the export file of this language is parsed. It's used by the
+        # parse workers, the files and the links are parsed by the Site merging them
+        self.language = language
         # the server name, e.g. "master.epfl.ch"
         self.server_name = ""
         # the root_path, by default it's empty
@@ -42,9 +60,13 @@ class Site:
         # the site languages
         self.languages = []
 
-        for file in os.listdir(base_path):
+        for file in self.source.listdir():
             if file.startswith("export_"):
                 language = file[7:9]
+
+                if self.language and language != self.language:
+                    continue
+
                 path = base_path + "/" + file
                 self.export_files[language] = path
                 self.languages.append(language)
@@ -64,6 +86,13 @@ class Site:
         # footer
         self.footer = {}
 
+        # the DOM backend used to parse each export file (lxml or beautifulsoup).
+        # The dict key is the language
+        self.dom_backends = {}
+
+        # the hits, misses and evictions of the DOM cache while parsing this site
+        self.dom_cache_stats = {}
+
         # the Pages indexed by their pid and uuid
         self.pages_by_pid = {}
         self.pages_by_uuid = {}
@@ -95,10 +124,26 @@ class Site:
 
         # parse the data
         self.parse_data()
+        self.source.close()
 
         # generate the report
         self.generate_report()
 
+    def __getattr__(self, name):
+        """
+        Called for the attributes not set yet: a Site loaded from the parse cache loads
+        its pages, boxes and files when they are first used. See parser.columnar
+        """
+        lazy_loader = self.__dict__.get("lazy_loader")
+
+        if lazy_loader is None or name not in LAZY_ATTRIBUTES:
+            raise AttributeError("'Site' object has no attribute '%s'" % name)
+
+        # the loader is kept if the loading fails, to raise the same error next time
+        lazy_loader.load(self)
+        del self.lazy_loader
+        return getattr(self, name)
+
     def full_path(self, path):
         """
         FIXME : should be done in Exporter
@@ -113,7 +158,7 @@ class Site:
 
         properties = {}
 
-        with open(self.base_path + "/site.properties") as file:
+        with io.TextIOWrapper(self.source.open(self.base_path + "/site.properties")) as file:
             lines = file.readlines()
 
             for line in lines:
@@ -154,31 +199,146 @@ class Site:
 
     def parse_data(self):
         """Parse the Site data"""
+        dom_cache = Utils.get_dom_cache()
+        dom_cache_stats = dom_cache.get_stats()
+
+        try:
+            # do the parsing
+            if self.parse_workers > 1 and len(self.export_files) > 1:
+                self.parse_export_files_in_workers()
+            elif self.streaming:
+                for language, path in self.export_files.items():
+                    self.parse_export_file_stream(language, path)
+            else:
+                self.parse_site_params()
+                self.parse_breadcrumb()
+                self.parse_footer()
+                self.parse_pages()
+
+            if not self.language:
+                self.parse_files()
+                self.fix_links()
+        finally:
+            # we don't need the DOMs anymore, even if the parsing failed
+            dom_cache.release(self)
+
+        # the parse workers stats are already merged
+        for key, value in dom_cache.get_stats().items():
+            self.dom_cache_stats[key] = self.dom_cache_stats.get(key, 0) + value - dom_cache_stats[key]
+
+    @staticmethod
+    def parse_language_helper(args):
+        """Parse the export file of one language, in a parse worker"""
+        base_path, name, root_path, streaming, language, source = args
+
+        return Site(base_path, name, root_path=root_path, streaming=streaming, language=language, source=source)
+
+    def parse_export_files_in_workers(self):
+        """
+        Parse each export file in a separate process, then merge the results.
+        Everything is independent between the languages until the links are fixed
+        """
+        args = [(self.base_path, self.name, self.root_path, self.streaming, language, self.source)
+                for language in self.export_files]
+
+        with Pool(processes=min(self.parse_workers, len(args))) as pool:
+            language_sites = pool.map(Site.parse_language_helper, args)
 
-        # do the parsing
-        self.parse_site_params()
-        self.parse_breadcrumb()
-        self.parse_footer()
-        self.parse_pages()
-        self.parse_pages_content()
-        self.parse_files()
-        self.fix_links()
+        # merge in the order of the export files, as if they were parsed here
+        for language_site in language_sites:
+            self.merge_language_site(language_site)
+
+    def merge_language_site(self, language_site):
+        """
+        Merge the given Site, parsed by a parse worker for one language. Its Pages
+        are added if we don't have them yet, and its PageContents are attached to
+        our Pages
+        """
+        language = language_site.language
+
+        self.dom_backends[language] = language_site.dom_backends[language]
+        self.set_site_params(
+            language=language,
+            title=language_site.title[language],
+            theme=language_site.theme[language],
+            acronym=language_site.acronym[language])
+
+        self.footer[language] = language_site.footer[language]
+
+        if language in language_site.breadcrumb_url:
+            self.breadcrumb_url[language] = language_site.breadcrumb_url[language]
+            self.breadcrumb_title[language] = language_site.breadcrumb_title[language]
+
+        for key, value in language_site.dom_cache_stats.items():
+            self.dom_cache_stats[key] = self.dom_cache_stats.get(key, 0) + value
+
+        # the PageContents already attached, by id
+        attached = set()
+
+        # the parents come before their children in pages_by_pid
+        for pid, language_page in language_site.pages_by_pid.items():
+            page_content = language_page.contents.get(language)
+            page = self.pages_by_pid.get(pid)
+
+            if not page:
+                page = language_page
+                parent = page.parent
+
+                page.site = self
+                page.parent = None
+                page.children = []
+                page.contents = {}
+
+                if parent:
+                    page.set_parent(self.pages_by_pid[parent.pid])
+
+                self.register_page(page)
+
+            if page_content:
+                self.attach_page_content(page_content)
+                attached.add(id(page_content))
+                page.contents[language] = page_content
+
+        for path, page_content in language_site.pages_content_by_path.items():
+            if id(page_content) not in attached:
+                self.attach_page_content(page_content)
+                attached.add(id(page_content))
+            self.pages_content_by_path[path] = page_content
+
+        self.inherit_sidebars(language)
+
+    def attach_page_content(self, page_content):
+        """Attach the given PageContent, parsed by a parse worker, to our Page"""
+        page_content.page = self.pages_by_pid[page_content.page.pid]
+        page_content.site = self
+
+        for box in page_content.boxes + page_content.sidebar.boxes:
+            box.site = self
 
     def parse_site_params(self,):
         """Parse the site params"""
         for language, dom_path in self.export_files.items():
-            dom = Utils.get_dom(dom_path)
-
-            self.title[language] = Utils.get_tag_attribute(dom, "siteName", "jahia:value")
-            self.theme[language] = Utils.get_tag_attribute(dom, "theme", "jahia:value")
-            self.acronym[language] = Utils.get_tag_attribute(dom, "acronym", "jahia:value")
-            self.css_url[language] = "//static.epfl.ch/v0.23.0/styles/%s-built.css" % self.theme[language]
+            dom = Utils.get_dom(dom_path, self.source)
+
+            self.dom_backends[language] = dom.backend
+            self.set_site_params(
+                language=language,
+                title=Utils.get_tag_attribute(dom, "siteName", "jahia:value"),
+                theme=Utils.get_tag_attribute(dom, "theme", "jahia:value"),
+                acronym=Utils.get_tag_attribute(dom, "acronym", "jahia:value"))
+
+    def set_site_params(self, language, title, theme, acronym):
+        """Set the site params for the given language"""
+        self.title[language] = title
+        self.theme[language] = theme
+        self.acronym[language] = acronym
+        self.css_url[language] = "//static.epfl.ch/v0.23.0/styles/%s-built.css" % self.theme[language]
 
     def parse_footer(self):
         """parse site footer"""
 
         for language, dom_path in self.export_files.items():
-            dom = Utils.get_dom(dom_path)
+            dom = Utils.get_dom(dom_path, self.source)
 
             # is positioned on children of main jahia:page element
             elements = dom.firstChild.childNodes
@@ -190,29 +350,29 @@ class Site:
                     continue
 
                 if "bottomLinksListList" == child.nodeName:
+                    self.set_footer(language, child)
+                    break
 
-                    nb_items_in_footer = len(child.getElementsByTagName("jahia:url"))
-
-                    if nb_items_in_footer == 0:
-                        """ This page has probably the default footer """
-                        break
+    def set_footer(self, language, element):
+        """Set the footer links from the given bottomLinksListList element"""
+        elements = element.getElementsByTagName("jahia:url")
 
-                    elif nb_items_in_footer > 0:
+        if len(elements) == 0:
+            """ This page has probably the default footer """
+            return
 
-                        elements = child.getElementsByTagName("jahia:url")
-                        for element in elements:
-                            link = Link(
-                                url=element.getAttribute('jahia:value'),
-                                title=element.getAttribute('jahia:title')
-                            )
-                            self.footer[language].append(link)
-                        break
+        for element in elements:
+            link = Link(
+                url=element.getAttribute('jahia:value'),
+                title=element.getAttribute('jahia:title')
+            )
+            self.footer[language].append(link)
 
     def parse_breadcrumb(self):
         """Parse the breadcrumb"""
 
         for language, dom_path in self.export_files.items():
-            dom = Utils.get_dom(dom_path)
+            dom = Utils.get_dom(dom_path, self.source)
 
             breadcrumb_links = dom.getElementsByTagName("breadCrumbLink")
             nb_found = len(breadcrumb_links)
@@ -220,27 +380,32 @@ class Site:
                 logging.warning("Found %s breadcrumb link(s) instead of 1", nb_found)
                 if nb_found == 0:
                     continue
-            breadcrumb_link = breadcrumb_links[0]
 
-            for child in breadcrumb_link.childNodes:
-                if child.ELEMENT_NODE != child.nodeType:
-                    continue
+            self.set_breadcrumb(language, breadcrumb_links[0])
 
-                if 'jahia:url' == child.nodeName:
-                    self.breadcrumb_url[language] = child.getAttribute('jahia:value')
-                    self.breadcrumb_title[language] = child.getAttribute('jahia:title')
-                    break
+    def set_breadcrumb(self, language, breadcrumb_link):
+        """Set the breadcrumb from the given breadCrumbLink element"""
+        for child in breadcrumb_link.childNodes:
+            if child.ELEMENT_NODE != child.nodeType:
+                continue
+
+            if 'jahia:url' == child.nodeName:
+                self.breadcrumb_url[language] = child.getAttribute('jahia:value')
+                self.breadcrumb_title[language] = child.getAttribute('jahia:title')
+                break
 
     def parse_pages(self):
         """
-        Parse the Pages. Here we parse only the common data between
-        multilingual pages
+        Parse the Pages and their PageContents in one pass over each export
+        file. The Page holds the common data between multilingual pages, it's
+        created the first time its pid is found. The PageContent is the content
+        that is specific for each language.
         """
 
         # we check each export files because a Page could be defined
         # in one language but not in another
         for language, dom_path in self.export_files.items():
-            dom = Utils.get_dom(dom_path)
+            dom = Utils.get_dom(dom_path, self.source)
 
             xml_pages = dom.getElementsByTagName("jahia:page")
 
@@ -252,63 +417,138 @@ class Site:
                 if template == "sitemap":
                     continue
 
-                # check if we already parsed this page
-                if pid in self.pages_by_pid:
-                    continue
+                # retrieve the Page if we already parsed it in another language.
+                # The parents come before their children in the export file
+                page = self.pages_by_pid.get(pid)
+
+                if not page:
+                    page = self.add_page(xml_page, parent_pid=dom.index.get_parent_pid(xml_page))
+
+                page_content = PageContent(page, language, xml_page)
+
+                self.parse_page_content_boxes(xml_page=xml_page, page_content=page_content, index=dom.index)
+
+                page.contents[language] = page_content
 
-                page = Page(self, xml_page)
+            self.inherit_sidebars(language)
 
-                # flag the homepage for convenience
-                if page.is_homepage():
-                    self.homepage = page
+    def add_page(self, xml_page, parent_pid=None):
+        """Create the Page of the given element and add it to the site"""
+        return self.register_page(Page(self, xml_page, parent_pid=parent_pid))
 
-                # add the Page to the cache
-                self.pages_by_pid[page.pid] = page
-                self.pages_by_uuid[page.uuid] = page
+    def register_page(self, page):
+        """Add the given Page to the site"""
+        # flag the homepage for convenience
+        if page.is_homepage():
+            self.homepage = page
 
-    def parse_pages_content(self):
+        # add the Page to the cache
+        self.pages_by_pid[page.pid] = page
+        self.pages_by_uuid[page.uuid] = page
+
+        return page
+
+    def parse_page_content_boxes(self, xml_page, page_content, index=None):
         """
-        Parse the PageContent. This is the content that is specific
-        for each language.
+        Parse the sidebar and the boxes of the given PageContent. The boxes are
+        taken from the given DomIndex, or from the page element itself when
+        streaming, as its sub-pages are already freed
         """
+        page_content.parse_sidebar(xml_page)
 
-        for language, dom_path in self.export_files.items():
-            dom = Utils.get_dom(dom_path)
+        # the tags that can contain boxes. Sidebar boxes that are in <extra> tags
+        # are parsed separately
+        tags = ["banner", "main", "col4", "col5" "col6", "col7", "col8"]
 
-            xml_pages = dom.getElementsByTagName("jahia:page")
+        for tag in tags:
+            if index:
+                elements = index.get_page_elements(xml_page, tag)
+            else:
+                elements = xml_page.getElementsByTagName(tag)
 
-            for xml_page in xml_pages:
-                pid = xml_page.getAttribute("jahia:pid")
-                template = xml_page.getAttribute("jahia:template")
+            self.add_boxes(elements=elements, page_content=page_content)
+
+    def parse_export_file_stream(self, language, path):
+        """
+        Parse the given export file without loading its DOM. Each jahia:page is
+        parsed as soon as it has been read, and freed right after
+        """
+        self.dom_backends[language] = jahia_dom.BACKEND_LXML_STREAMING
+        self.footer[language] = []
+
+        site_params = {}
+        nb_breadcrumb_links = 0
+        footer_found = False
+
+        # the PageContents being parsed, None for the sitemaps
+        page_contents = []
 
+        for event, element, parent_pid in jahia_dom.iterparse_pages(path, tags=self.STREAMED_TAGS, source=self.source):
+
+            if jahia_dom.ELEMENT == event:
+                if element.tag in ("siteName", "theme", "acronym"):
+                    site_params.setdefault(element.tag, element.getAttribute("jahia:value"))
+
+                elif "breadCrumbLink" == element.tag:
+                    if nb_breadcrumb_links == 0:
+                        self.set_breadcrumb(language, element)
+                    nb_breadcrumb_links += 1
+
+                # the footer is positioned on children of main jahia:page element
+                elif not footer_found and element.parentNode.parentNode is None:
+                    self.set_footer(language, element)
+                    footer_found = True
+
+            elif jahia_dom.PAGE_START == event:
                 # we don't parse the sitemap as it's not a real page
-                if template == "sitemap":
+                if element.getAttribute("jahia:template") == "sitemap":
+                    page_contents.append(None)
                     continue
 
-                # retrieve the Page definition that we already parsed
-                page = self.pages_by_pid[pid]
-                page_content = PageContent(page, language, xml_page)
+                page = self.pages_by_pid.get(element.getAttribute("jahia:pid"))
 
-                # the tags that can contain boxes. Sidebar boxes that are in <extra> tags
-                # are parsed separately
-                tags = ["banner", "main", "col4", "col5" "col6", "col7", "col8"]
+                if not page:
+                    page = self.add_page(element, parent_pid=parent_pid)
 
-                for tag in tags:
-                    self.add_boxes(xml_page=xml_page,
-                                   page_content=page_content,
-                                   tag=tag)
+                page_contents.append(PageContent(page, language, element))
 
-                page.contents[language] = page_content
+            else:
+                page_content = page_contents.pop()
 
-    def add_boxes(self, xml_page, page_content, tag):
-        # add the boxes contained in the given tag to the given page_content
-        elements = xml_page.getElementsByTagName(tag)
+                if page_content:
+                    self.parse_page_content_boxes(xml_page=element, page_content=page_content)
 
-        for element in elements:
-            # check if the box belongs to the current page
-            if not self.belongs_to(element, page_content.page):
-                continue
+                    page_content.page.contents[language] = page_content
+
+        self.set_site_params(
+            language=language,
+            title=site_params.get("siteName", ""),
+            theme=site_params.get("theme", ""),
+            acronym=site_params.get("acronym", ""))
+
+        if nb_breadcrumb_links != 1:
+            logging.warning("Found %s breadcrumb link(s) instead of 1", nb_breadcrumb_links)
+
+        self.inherit_sidebars(language)
+
+    def inherit_sidebars(self, language):
+        """
+        Inherit the parents sidebar in the PageContents of the given language, once
+        all of them have been parsed. The parents are always added before their
+        children in pages_by_pid
+        """
+        # the parents of the pages parsed by a parse worker may come from another
+        # language, so the Site merging the worker results does it
+        if self.language:
+            return
+
+        for page in self.pages_by_pid.values():
+            if language in page.contents:
+                page.contents[language].inherit_sidebar()
 
+    def add_boxes(self, elements, page_content):
+        # add the boxes of the given elements, that belong to the page, to the given page_content
+        for element in elements:
             type = element.getAttribute("jcr:primaryType")
 
             # the "epfl:faqBox" element contains one or more "epfl:faqList"
@@ -322,7 +562,7 @@ class Site:
             else:
                 # TODO remove the multibox parameter and check for combo boxes instead
                 # Check if xml_box contains many boxes
-                multibox = element.getElementsByTagName("text").length > 1
+                multibox = len(element.getElementsByTagName("text")) > 1
                 box = Box(site=self, page_content=page_content, element=element, multibox=multibox)
                 page_content.boxes.append(box)
 
@@ -330,13 +570,12 @@ class Site:
         """Parse the files"""
         start = "%s/content/sites/%s/files" % (self.base_path, self.name)
 
-        for (path, dirs, files) in os.walk(start):
-            for file_name in files:
-                # we exclude the thumbnails
-                if file_name in ["thumbnail", "thumbnail2"]:
-                    continue
+        for (path, file_name) in self.source.walk_files(start):
+            # we exclude the thumbnails
+            if file_name in ["thumbnail", "thumbnail2"]:
+                continue
 
-                self.files.append(File(name=file_name, path=path))
+            self.files.append(File(name=file_name, path=path))
 
     def get_all_boxes(self):
         """
@@ -355,14 +594,16 @@ class Site:
 
         return boxes
 
-    def belongs_to(self, element, page):
-        """Check if the given element belongs to the given page"""
-        parent = element.parentNode
-
-        while "jahia:page" != parent.nodeName:
-            parent = parent.parentNode
+    def get_last_update(self):
+        """
+        Returns the most recent last update of the PageContents, or None
+        """
+        last_updates = [page_content.last_update
+                        for page in self.pages_by_pid.values()
+                        for page_content in page.contents.values()
+                        if page_content.last_update]
 
-        return page.pid == parent.getAttribute("jahia:pid")
+        return max(last_updates) if last_updates else None
 
     def fix_links(self):
         """
@@ -370,120 +611,104 @@ class Site:
         when all the pages have been parsed.
         """
         for box in self.get_all_boxes():
-            soup = BeautifulSoup(box.content, 'html.parser')
-
-            self.fix_links_in_tag(box=box, soup=soup, tag_name="a", attribute="href")
-            self.fix_links_in_tag(box=box, soup=soup, tag_name="img", attribute="src")
-            self.fix_links_in_tag(box=box, soup=soup, tag_name="script", attribute="src")
+            box.content = rewrite_links(box.content, lambda tag_name, link, box=box: self.fix_link(box, link))
 
-    def fix_links_in_tag(self, box, soup, tag_name, attribute):
+    def fix_link(self, box, link):
         """
-        Fix the links in the given type of tag
+        Returns the fixed link of the given box, or None if it's kept as is
         """
-        tags = soup.find_all(tag_name)
-
-        for tag in tags:
-            link = tag.get(attribute)
-
-            if not link:
-                continue
-
-            # links we are ignoring
-            ignore = ["javascript", "tel://", "tel:", "callto:", "smb://", "file://"]
+        # links we are ignoring
+        ignore = ["javascript", "tel://", "tel:", "callto:", "smb://", "file://"]
 
-            for element in ignore:
-                if link.startswith(element):
-                    return
+        for element in ignore:
+            if link.startswith(element):
+                return None
 
-            # internal Jahia links
-            if link.startswith("###page"):
-                uuid = link[link.rfind('/') + 1:]
+        new_link = None
 
-                # check if we have a Page with this uuid
-                if uuid in self.pages_by_uuid:
-                    page = self.pages_by_uuid[uuid]
+        # internal Jahia links
+        if link.startswith("###page"):
+            uuid = link[link.rfind('/') + 1:]
 
-                    # check if we have a PageContent with this language
-                    if box.page_content.language in page.contents:
-                        new_link = page.contents[box.page_content.language].path
+            # check if we have a Page with this uuid
+            if uuid in self.pages_by_uuid:
+                page = self.pages_by_uuid[uuid]
 
-                        tag[attribute] = new_link
+                # check if we have a PageContent with this language
+                if box.page_content.language in page.contents:
+                    new_link = page.contents[box.page_content.language].path
 
-                        self.internal_links += 1
-                    else:
-                        logging.debug("Found a broken link : " + link)
-                        self.broken_links += 1
+                    self.internal_links += 1
                 else:
                     logging.debug("Found a broken link : " + link)
                     self.broken_links += 1
+            else:
+                logging.debug("Found a broken link : " + link)
+                self.broken_links += 1
 
-            # some weird internal links look like :
-            # /cms/op/edit/PAGE_NAME or
-            # /cms/site/SITE_NAME/op/edit/lang/LANGUAGE/PAGE_NAME
-            elif "/op/edit/" in link:
-                new_link = link[link.index("/op/edit") + 8:]
-
-                if new_link.startswith("/lang/"):
-                    new_link = new_link[8:]
-
-                tag[attribute] = new_link
-
-                self.internal_links += 1
-            # internal links written by hand, e.g.
-            # /team
-            # /page-92507-fr.html
-            # FIXME : will not work it root_path is set to a subdir
-            elif link in self.pages_content_by_path:
-                self.internal_links += 1
-            # absolute links rewritten as relative links
-            elif link.startswith("http://" + self.server_name) or \
-                    link.startswith("https://" + self.server_name):
-
-                new_link = link[link.index(self.server_name) + len(self.server_name):]
-
-                tag[attribute] = self.full_path(new_link)
-
-                self.absolute_links += 1
-            # file links
-            elif link.startswith("###file"):
-                if "/files/" in link:
-                    new_link = link[link.index('/files/'):]
-
-                    if "?" in new_link:
-                        new_link = new_link[:new_link.index("?")]
-
-                    tag[attribute] = self.full_path(new_link)
-
-                    self.file_links += 1
-                # if we don't have /files/ in the path the link is broken (happen
-                # only in 3 sites)
-                else:
-                    self.broken_links += 1
-                    logging.debug("Found broken file link %s", link)
-            # broken file links
-            elif link.startswith("/fileNotFound###"):
+        # some weird internal links look like :
+        # /cms/op/edit/PAGE_NAME or
+        # /cms/site/SITE_NAME/op/edit/lang/LANGUAGE/PAGE_NAME
+        elif "/op/edit/" in link:
+            new_link = link[link.index("/op/edit") + 8:]
+
+            if new_link.startswith("/lang/"):
+                new_link = new_link[8:]
+
+            self.internal_links += 1
+        # internal links written by hand, e.g.
+        # /team
+        # /page-92507-fr.html
+        # FIXME : will not work it root_path is set to a subdir
+        elif link in self.pages_content_by_path:
+            self.internal_links += 1
+        # absolute links rewritten as relative links
+        elif link.startswith("http://" + self.server_name) or \
+                link.startswith("https://" + self.server_name):
+
+            new_link = self.full_path(link[link.index(self.server_name) + len(self.server_name):])
+
+            self.absolute_links += 1
+        # file links
+        elif link.startswith("###file"):
+            if "/files/" in link:
+                new_link = link[link.index('/files/'):]
+
+                if "?" in new_link:
+                    new_link = new_link[:new_link.index("?")]
+
+                new_link = self.full_path(new_link)
+
+                self.file_links += 1
+            # if we don't have /files/ in the path the link is broken (happen
+            # only in 3 sites)
+            else:
                 self.broken_links += 1
                 logging.debug("Found broken file link %s", link)
-            # those are files links we already fixed, so we pass
-            elif link.startswith(self.root_path + "/files/"):
-                pass
-            # external links
-            elif link.startswith("http://") or link.startswith("https://") or link.startswith("//"):
-                self.external_links += 1
-            # data links
-            elif link.startswith("data:"):
-                self.data_links += 1
-            # mailto links
-            elif link.startswith("mailto:"):
-                self.mailto_links += 1
-            # HTML anchors
-            elif link.startswith("#"):
-                self.anchor_links += 1
-            else:
-                logging.debug("Found unknown link %s", link)
-                self.unknown_links += 1
+        # broken file links
+        elif link.startswith("/fileNotFound###"):
+            self.broken_links += 1
+            logging.debug("Found broken file link %s", link)
+        # those are files links we already fixed, so we pass
+        elif link.startswith(self.root_path + "/files/"):
+            pass
+        # external links
+        elif link.startswith("http://") or link.startswith("https://") or link.startswith("//"):
+            self.external_links += 1
+        # data links
+        elif link.startswith("data:"):
+            self.data_links += 1
+        # mailto links
+        elif link.startswith("mailto:"):
+            self.mailto_links += 1
+        # HTML anchors
+        elif link.startswith("#"):
+            self.anchor_links += 1
+        else:
+            logging.debug("Found unknown link %s", link)
+            self.unknown_links += 1
 
-        box.content = str(soup)
+        return new_link
 
     def generate_report(self):
         """Generate the report of what has been parsed"""
@@ -525,3 +750,11 @@ Parsed for %s :
         self.report += "    - %s anchor links\n" % self.anchor_links
         self.report += "    - %s broken links\n" % self.broken_links
         self.report += "    - %s unknown links\n" % self.unknown_links
+
+        self.report += "\n  - export files :\n\n"
+
+        for language, backend in sorted(self.dom_backends.items()):
+            self.report += "    - %s parsed with %s\n" % (os.path.basename(self.export_files[language]), backend)
+
+        self.report += "    - DOM cache : %(hits)s hits, %(misses)s misses, %(evictions)s evictions\n" % \
+            self.dom_cache_stats
@@ -0,0 +1,126 @@
+"""(c) All rights reserved. ECOLE POLYTECHNIQUE FEDERALE DE LAUSANNE, Switzerland, VPSI, 2017"""
+import re
+from html import unescape
+
+"""
+Link rewriting in the HTML of the boxes.
+
+The HTML is scanned once for the start tags holding links (e.g. <a href>), and the
+rewritten links are spliced in the original string: the rest of the HTML is kept as
+is, instead of being parsed into a BeautifulSoup tree and serialized back.
+
+The tags are found like the html.parser module does, which BeautifulSoup uses, so
+the comments and the content of the <script> and <style> elements are skipped.
+"""
+
+# the attribute holding the link, for each tag name
+LINK_ATTRIBUTES = {"a": "href", "img": "src", "script": "src"}
+
+# the beginning of the markups: comment or CDATA section, other markups (end tag,
+# declaration...) or start tag
+MARKUP = re.compile(r"<(?:(!--|!\[CDATA\[)|[!?/]|([a-zA-Z][^\t\n\r\f />\x00]*))")
+
+# the end of the comments and CDATA sections
+SECTION_END = {"!--": "-->", "![CDATA[": "]]>"}
+
+# a whole start tag, with the attributes in the "attributes" group
+START_TAG = re.compile(r"""
+    <[a-zA-Z][^\t\n\r\f />\x00]*
+    (?P<attributes>(?:[\s/]*
+        (?<=['"\s/])[^\s/>][^\s/=>]*
+        (?:\s*=+\s*(?:'[^']*'|"[^"]*"|(?!['"])[^>\s]*)\s*)?
+    )*)
+    [\s/]*>
+""", re.VERBOSE)
+
+# an attribute in a start tag, with its raw value
+ATTRIBUTE = re.compile(r"""([^\s/>][^\s/=>]*)(?:\s*=+\s*('[^']*'|"[^"]*"|(?!['"])[^>\s]*))?""")
+
+# the end of the elements whose content is not HTML
+RAW_TEXT_END = {
+    "script": re.compile(r"</\s*script\s*>", re.IGNORECASE),
+    "style": re.compile(r"</\s*style\s*>", re.IGNORECASE),
+}
+
+
+def quote_attribute(value):
+    """Returns the given attribute value escaped and quoted, as BeautifulSoup would"""
+    value = value.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
+
+    if '"' not in value:
+        return '"%s"' % value
+    if "'" not in value:
+        return "'%s'" % value
+    return '"%s"' % value.replace('"', "&quot;")
+
+
+def rewrite_links(content, rewrite, link_attributes=LINK_ATTRIBUTES):
+    """
+    Returns the given HTML with its links rewritten, in one pass.
+
+    rewrite(tag_name, link) is called for each link, in the order of the HTML,
+    and returns the new link, or None to keep it.
+
+    link_attributes is the attribute holding the link, by tag name.
+    """
+    parts = []
+    # the end of the HTML already copied in parts
+    copied = 0
+    position = 0
+
+    while True:
+        markup = MARKUP.search(content, position)
+
+        if not markup:
+            break
+
+        # comments and CDATA sections
+        if markup.group(1):
+            section_end = SECTION_END[markup.group(1)]
+            end = content.find(section_end, markup.end())
+            position = len(content) if end < 0 else end + len(section_end)
+            continue
+
+        tag_name = markup.group(2)
+        start_tag = START_TAG.match(content, markup.start()) if tag_name else None
+
+        if not start_tag:
+            position = markup.end()
+            continue
+
+        position = start_tag.end()
+        tag_name = tag_name.lower()
+        attribute_name = link_attributes.get(tag_name)
+
+        if attribute_name:
+            # like BeautifulSoup, the last attribute wins
+            attribute = None
+
+            for match in ATTRIBUTE.finditer(content, start_tag.start("attributes"), start_tag.end("attributes")):
+                if match.group(1).lower() == attribute_name:
+                    attribute = match
+
+            value = attribute and attribute.group(2)
+
+            if value:
+                if value[0] in "'\"" and value[0] == value[-1]:
+                    value = value[1:-1]
+
+                link = unescape(value)
+                new_link = rewrite(tag_name, link) if link else None
+
+                if new_link is not None and new_link != link:
+                    parts.append(content[copied:attribute.start(2)])
+                    parts.append(quote_attribute(new_link))
+                    copied = attribute.end(2)
+
+        if tag_name in RAW_TEXT_END:
+            end = RAW_TEXT_END[tag_name].search(content, position)
+            position = len(content) if not end else end.end()
+
+    if not parts:
+        return content
+
+    parts.append(content[copied:])
+
+    return "".join(parts)
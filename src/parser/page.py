@@ -2,9 +2,14 @@
 
 
 class Page:
-    """A Jahia Page. Has 1 to N Jahia Boxes"""
+    """
+    A Jahia Page. Has 1 to N Jahia Boxes.
 
-    def __init__(self, site, element):
+    The parent_pid is the pid of the parent page, None for the homepage. It's
+    taken from the DomIndex, or from the stack of pages when streaming
+    """
+
+    def __init__(self, site, element, parent_pid=None):
         # common data for all languages
         self.pid = element.getAttribute("jahia:pid")
         self.uuid = element.getAttribute("jcr:uuid")
@@ -25,8 +30,8 @@ class Page:
         if "sitemap" == self.template:
             return
 
-        # find the Page parent
-        self.set_parent(element)
+        if parent_pid is not None:
+            self.set_parent(self.site.pages_by_pid[parent_pid])
 
     def is_homepage(self):
         """
@@ -40,32 +45,16 @@ class Page:
         """
         return len(self.children) > 0
 
-    def set_parent(self, element):
+    def set_parent(self, parent):
         """
-        Find the page parent
+        Set the page parent. The parents are created before their children,
+        so the parent level is already known
         """
-        element_parent = element.parentNode
-
-        while "jahia:page" != element_parent.nodeName:
-            element_parent = element_parent.parentNode
-
-            # we reached the top of the document
-            if not element_parent:
-                break
-
-        if element_parent:
-            self.parent = self.site.pages_by_pid[element_parent.getAttribute("jahia:pid")]
-            self.parent.children.append(self)
-
-            # calculate the page level
-            self.level = 1
-
-            parent_page = self.parent
-
-            while not parent_page.is_homepage():
-                self.level += 1
+        self.parent = parent
+        self.parent.children.append(self)
 
-                parent_page = parent_page.parent
+        # calculate the page level
+        self.level = self.parent.level + 1
 
     def __str__(self):
         return self.pid + " " + self.template
@@ -26,9 +26,6 @@ class PageContent:
         # last update
         self.parse_last_update(element)
 
-        # sidebar
-        self.parse_sidebar(element)
-
         # path
         self.set_path(element)
 
@@ -47,7 +44,10 @@ class PageContent:
                 self.site.name, self.page.pid, date)
 
     def parse_sidebar(self, element):
-        """ Parse sidebar """
+        """
+        Parse the sidebar boxes of the page. The sidebar of the parents is
+        inherited later, see inherit_sidebar()
+        """
 
         # search the sidebar in the page xml content
         children = element.childNodes
@@ -59,6 +59,11 @@ class PageContent:
                     box = Box(site=self.site, page_content=self, element=extra)
                     self.sidebar.boxes.append(box)
 
+    def inherit_sidebar(self):
+        """
+        Use the sidebar of the nearest parent if the page has no sidebar boxes.
+        The parents sidebar must be set first
+        """
         nb_boxes = len(self.sidebar.boxes)
 
         # if we don't have boxes in this sidebar we check the parents
@@ -0,0 +1,115 @@
+"""(c) All rights reserved. ECOLE POLYTECHNIQUE FEDERALE DE LAUSANNE, Switzerland, VPSI, 2017"""
+
+import glob
+import hashlib
+import logging
+import os
+import pickle
+import timeit
+
+from parser import columnar
+from settings import VERSION
+
+
+class ParseCache(object):
+    """
+        The parsed Site, saved in <output_subdir>/parsed_<site_name>.pkl with a header
+        telling if it's still valid:
+
+        * 'version': the jahiap version and a hash of the parser code
+        * 'root_path': the root_path of the Site
+        * 'sources': the fingerprints of the files the Site was parsed from, i.e.
+          site.properties and the export files (see site_source)
+
+        The header is pickled before the Site, so it's read without loading the Site.
+        The Site is saved in columns, its pages being loaded when first used (see columnar).
+    """
+
+    FILE_PATTERN = "parsed_%s.pkl"
+
+    # the modules outside of the parser package used by the parsing, e.g. Utils.get_dom
+    # and the DomCache, or the date format of the settings
+    PARSER_DEPENDENCIES = ("utils.py", "settings.py")
+
+    # the version of the parser, computed when first used
+    parser_version = None
+
+    def __init__(self, output_subdir, site_name):
+        self.path = os.path.join(output_subdir, self.FILE_PATTERN % site_name)
+        self.site_name = site_name
+
+    @classmethod
+    def get_parser_version(cls):
+        """Returns the jahiap version and a hash of the parser modules, and of their dependencies"""
+        if cls.parser_version is None:
+            checksum = hashlib.sha256()
+            parser_dir = os.path.dirname(os.path.abspath(__file__))
+            paths = sorted(glob.glob(os.path.join(parser_dir, "*.py")))
+            paths.extend(os.path.join(os.path.dirname(parser_dir), name) for name in cls.PARSER_DEPENDENCIES)
+
+            for path in paths:
+                with open(path, 'rb') as module:
+                    checksum.update(module.read())
+
+            cls.parser_version = "%s-%s" % (VERSION, checksum.hexdigest()[:16])
+
+        return cls.parser_version
+
+    @staticmethod
+    def get_header(source, root_path):
+        """Returns the header of a Site parsed from the given source"""
+        names = [name for name in source.listdir() if name == "site.properties" or name.startswith("export_")]
+
+        return {
+            'version': ParseCache.get_parser_version(),
+            'root_path': root_path,
+            'sources': {name: source.get_fingerprint(source.path + "/" + name) for name in names},
+        }
+
+    def load(self, source, root_path):
+        """
+            Returns the cached Site if it was parsed from the same files by the same
+            parser, else None. The Site then reads its files from the given source
+        """
+        if not os.path.isfile(self.path):
+            return None
+
+        start_time = timeit.default_timer()
+
+        with open(self.path, 'rb') as input:
+            try:
+                header = pickle.load(input)
+            except Exception as err:
+                logging.warning("%s - parse - Invalid parse cache %s: %s", self.site_name, self.path, err)
+                return None
+
+            expected_header = self.get_header(source, root_path)
+
+            if not isinstance(header, dict) or header != expected_header:
+                changes = [key for key, value in expected_header.items()
+                           if not isinstance(header, dict) or header.get(key) != value]
+                logging.info("Parse cache %s is stale (%s changed)", self.path, ", ".join(changes))
+                return None
+
+            site = columnar.load_site(self.path, input, source)
+
+        logging.info("Loaded parsed site from %s (%.1f MB) in %.2fs",
+                     self.path, os.path.getsize(self.path) / (1024 * 1024), timeit.default_timer() - start_time)
+        return site
+
+    def save(self, site):
+        """Save the given Site, atomically so that the cache is never half written"""
+        start_time = timeit.default_timer()
+        tmp_path = self.path + ".tmp"
+
+        header = self.get_header(site.source, site.root_path)
+        site.source.close()
+
+        with open(tmp_path, 'wb') as output:
+            pickle.dump(header, output, pickle.HIGHEST_PROTOCOL)
+            columnar.dump_site(site, output)
+
+        os.replace(tmp_path, self.path)
+
+        logging.info("Parsed site saved into %s (%.1f MB) in %.2fs",
+                     self.path, os.path.getsize(self.path) / (1024 * 1024), timeit.default_timer() - start_time)
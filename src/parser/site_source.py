@@ -0,0 +1,172 @@
+"""(c) All rights reserved. ECOLE POLYTECHNIQUE FEDERALE DE LAUSANNE, Switzerland, VPSI, 2017"""
+
+import os
+import shutil
+import zipfile
+from collections import OrderedDict
+from contextlib import ExitStack
+
+from unzipper.unzip import open_site_zip, get_metadata_only_zip
+
+"""
+    Where the files of a site are read from: the directory where the site has been
+    unzipped, or the site zip itself, without extracting it.
+
+    The files are always designated by their path in the site directory, i.e.
+    <path>/site.properties, <path>/export_en.xml... even when they are read from
+    the zip, so that the parsed data (e.g. the File paths) are the same.
+"""
+
+
+class DirectorySource(object):
+    """
+    The files of a site unzipped in the given path. If only the files needed to parse
+    the site were unzipped (see unzip_one), the others are read from 'zip_source'
+    """
+
+    def __init__(self, path, zip_source=None):
+        self.path = path
+        self.zip_source = zip_source
+
+    def listdir(self):
+        """Returns the names of the files at the root of the site"""
+        return os.listdir(self.path)
+
+    def exists(self, path):
+        return os.path.exists(path) or bool(self.zip_source and self.zip_source.exists(path))
+
+    def open(self, path):
+        """Returns the given file, opened in binary mode"""
+        if self.zip_source and not os.path.exists(path):
+            return self.zip_source.open(path)
+
+        return open(path, 'rb')
+
+    def get_size(self, path):
+        if self.zip_source and not os.path.exists(path):
+            return self.zip_source.get_size(path)
+
+        return os.path.getsize(path)
+
+    def get_fingerprint(self, path):
+        """Returns what changes when the given file changes: its size and mtime"""
+        if self.zip_source and not os.path.exists(path):
+            return self.zip_source.get_fingerprint(path)
+
+        stat = os.stat(path)
+        return [stat.st_size, stat.st_mtime]
+
+    def walk_files(self, path):
+        """Yields (directory path, file name) for each file under the given path"""
+        if self.zip_source:
+            yield from self.zip_source.walk_files(path)
+            return
+
+        for (directory, dirs, files) in os.walk(path):
+            for file_name in files:
+                yield directory, file_name
+
+    def close(self):
+        if self.zip_source:
+            self.zip_source.close()
+
+
+class ZipSource(object):
+    """
+    The files of a site read from <site_name>.zip in the given Jahia export zip.
+    The files are designated by their path as if the zip was unzipped in 'path'.
+
+    The zip is opened when first used, and closed by close(). The source can be
+    pickled, e.g. with the parsed Site, and is opened again when used afterwards
+    """
+
+    def __init__(self, zip_file, site_name, path):
+        if not zip_file or not os.path.isfile(zip_file):
+            raise ValueError("Jahia zip file %s not found" % zip_file)
+
+        self.zip_file = zip_file
+        self.site_name = site_name
+        self.path = path
+
+        self.exit_stack = None
+        self.site_zip = None
+        # the members of the site zip, indexed by name
+        self.infos = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.update(exit_stack=None, site_zip=None, infos=None)
+        return state
+
+    def get_site_zip(self):
+        """Returns the ZipFile of the site zip, opening it if needed"""
+        if self.site_zip is None:
+            self.exit_stack = ExitStack()
+            site_file, _ = self.exit_stack.enter_context(open_site_zip(self.zip_file, self.site_name))
+            self.site_zip = self.exit_stack.enter_context(zipfile.ZipFile(site_file, 'r'))
+            self.infos = {info.filename: info for info in self.site_zip.infolist()}
+
+        return self.site_zip
+
+    def get_name(self, path):
+        """Returns the name in the site zip of the given file path"""
+        return os.path.relpath(path, self.path).replace(os.sep, "/")
+
+    def listdir(self):
+        """Returns the names of the files at the root of the site"""
+        self.get_site_zip()
+        # in the order of the zip, as os.listdir in the directory it was made from
+        return list(OrderedDict.fromkeys(name.split("/")[0] for name in self.infos))
+
+    def exists(self, path):
+        self.get_site_zip()
+        name = self.get_name(path)
+        return name in self.infos or any(other.startswith(name + "/") for other in self.infos)
+
+    def open(self, path):
+        """Returns the given file, opened in binary mode"""
+        return self.get_site_zip().open(self.infos[self.get_name(path)])
+
+    def get_size(self, path):
+        self.get_site_zip()
+        return self.infos[self.get_name(path)].file_size
+
+    def get_fingerprint(self, path):
+        """Returns what changes when the given file changes: its size and CRC"""
+        self.get_site_zip()
+        info = self.infos[self.get_name(path)]
+        return [info.file_size, info.CRC]
+
+    def walk_files(self, path):
+        """Yields (directory path, file name) for each file under the given path"""
+        self.get_site_zip()
+        prefix = self.get_name(path) + "/"
+
+        for name, info in self.infos.items():
+            if name.startswith(prefix) and not info.is_dir():
+                directory, file_name = name.rsplit("/", 1)
+                yield self.path + "/" + directory, file_name
+
+    def close(self):
+        if self.exit_stack:
+            self.exit_stack.close()
+
+        self.exit_stack = None
+        self.site_zip = None
+        self.infos = None
+
+
+def get_site_source(path, site_name):
+    """Returns the source of the site unzipped in the given path"""
+    zip_file = get_metadata_only_zip(path)
+
+    if zip_file:
+        return DirectorySource(path, zip_source=ZipSource(zip_file, site_name, path))
+
+    return DirectorySource(path)
+
+
+def copy_file(source, path, destination):
+    """Copy the given file of the source to the destination path"""
+    with source.open(path) as input, open(destination, 'wb') as output:
+        shutil.copyfileobj(input, output, 1024 * 1024)
@@ -0,0 +1,85 @@
+"""(c) All rights reserved. ECOLE POLYTECHNIQUE FEDERALE DE LAUSANNE, Switzerland, VPSI, 2017
+
+    Micro-benchmark of the owner page lookups: the ancestor walks formerly done by
+    Site.belongs_to and Page.set_parent, against the DomIndex built in one pass.
+
+    Run from the src directory, with the jahia-data submodule:
+        `python -m parser.test.benchmark_owner_page [<site> ...]`
+"""
+import os
+import sys
+import timeit
+
+from parser import dom as jahia_dom
+from settings import DATA_PATH
+
+# the tags that can contain boxes, as in Site.parse_page_content_boxes
+BOX_TAGS = ["banner", "main", "col4", "col5" "col6", "col7", "col8"]
+
+
+def walk_owner_pid(element):
+    """The former lookup: walk up to the nearest jahia:page"""
+    parent = element.parentNode
+
+    while parent is not None and "jahia:page" != parent.nodeName:
+        parent = parent.parentNode
+
+    if parent is not None:
+        return parent.getAttribute("jahia:pid")
+
+
+def with_walks(document):
+    """Find the owner of every box and the parent and level of every page with ancestor walks"""
+    parent_pids = {}
+
+    root = document.firstChild
+
+    for page in [root] + root.getElementsByTagName("jahia:page"):
+        parent_pids[page.getAttribute("jahia:pid")] = walk_owner_pid(page)
+
+        for tag in BOX_TAGS:
+            for element in page.getElementsByTagName(tag):
+                walk_owner_pid(element)
+
+    for pid in parent_pids:
+        level = 0
+        parent_pid = parent_pids[pid]
+        while parent_pid is not None:
+            level += 1
+            parent_pid = parent_pids[parent_pid]
+
+
+def with_index(document):
+    """Same lookups, with a fresh DomIndex"""
+    document._index = None
+    index = document.index
+    levels = {}
+
+    for page in index.get_elements("jahia:page"):
+        parent_pid = index.get_parent_pid(page)
+        levels[page.getAttribute("jahia:pid")] = levels[parent_pid] + 1 if parent_pid else 0
+
+        for tag in BOX_TAGS:
+            index.get_page_elements(page, tag)
+
+
+def benchmark(site_name, number=10):
+    site_path = os.path.join(DATA_PATH, site_name)
+
+    for file_name in sorted(os.listdir(site_path)):
+        if not file_name.startswith("export_"):
+            continue
+
+        document = jahia_dom.parse(os.path.join(site_path, file_name))
+        nb_pages = len(document.getElementsByTagName("jahia:page"))
+
+        walks = timeit.timeit(lambda: with_walks(document), number=number) / number
+        index = timeit.timeit(lambda: with_index(document), number=number) / number
+
+        print("%s/%s (%s pages): ancestor walks %.1f ms, index %.1f ms (x%.1f)" % (
+            site_name, file_name, nb_pages, walks * 1000, index * 1000, walks / index))
+
+
+if __name__ == '__main__':
+    for site_name in sys.argv[1:] or ['dcsl', 'master']:
+        benchmark(site_name)
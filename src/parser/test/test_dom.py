@@ -0,0 +1,144 @@
+from collections import namedtuple
+
+from parser import dom
+from utils import DomCache
+
+XML = """<?xml version="1.0" encoding="UTF-8"?>
+<jahia:page xmlns:jahia="http://www.jahia.org/" jahia:pid="1" jahia:title="Home&#10;page">
+  <!-- comment -->
+  <mainList>
+    <main><text jahia:value="&lt;p&gt;hello&#13;&#10;world&lt;/p&gt;"/></main>
+  </mainList>
+  <childrenList>
+    <jahia:page jahia:pid="2"><main/></jahia:page>
+  </childrenList>
+</jahia:page>
+"""
+
+
+def get_document(tmpdir, content=XML):
+    path = tmpdir.join("export_en.xml")
+    path.write(content)
+    return dom.parse(str(path))
+
+
+class TestDom:
+
+    def test_backend(self, tmpdir):
+        assert get_document(tmpdir).backend == dom.BACKEND_LXML
+
+    def test_get_elements_by_tag_name(self, tmpdir):
+        document = get_document(tmpdir)
+        pages = document.getElementsByTagName("jahia:page")
+        assert [page.getAttribute("jahia:pid") for page in pages] == ["1", "2"]
+        assert len(pages[0].getElementsByTagName("main")) == 2
+        assert pages[1].getElementsByTagName("jahia:page") == []
+
+    def test_minidom_attributes(self, tmpdir):
+        document = get_document(tmpdir)
+        root = document.firstChild
+        assert root.nodeName == "jahia:page"
+        assert root.getAttribute("jahia:title") == "Home page"
+        assert root.getAttribute("missing") == ""
+        assert [child.nodeName for child in root.childNodes] == ["mainList", "childrenList"]
+        text = root.getElementsByTagName("text")[0]
+        assert text.getAttribute("jahia:value") == "<p>hello world</p>"
+        assert text.parentNode.nodeName == "main"
+        assert root.parentNode is None
+
+    def test_index(self, tmpdir):
+        document = get_document(tmpdir)
+        index = document.index
+        root = document.firstChild
+        sub_page = index.get_page("2")
+        assert sub_page.getAttribute("jahia:pid") == "2"
+        assert len(index.get_elements("main")) == 2
+        # the elements of the sub-pages are not owned by the page
+        assert index.get_page_elements(root, "main") == root.getElementsByTagName("main")[:1]
+        assert index.get_page_elements(root, "jahia:page") == [sub_page]
+        assert index.get_page_elements(sub_page, "main") == sub_page.getElementsByTagName("main")
+        assert index.get_parent_pid(root) is None
+        assert index.get_parent_pid(sub_page) == "1"
+        assert document.get_first_element_by_tag_name("text").getAttribute("jahia:value") == "<p>hello world</p>"
+
+    def test_iterparse_pages(self, tmpdir):
+        get_document(tmpdir)
+        events = []
+        for event, element, parent_pid in dom.iterparse_pages(str(tmpdir.join("export_en.xml")), tags=["text"]):
+            if dom.PAGE_END == event:
+                # the sub-pages are already freed
+                assert element.getElementsByTagName("jahia:page") == []
+            events.append((event, element.getAttribute("jahia:pid"), parent_pid))
+        assert events == [
+            (dom.PAGE_START, "1", None),
+            (dom.ELEMENT, "", "1"),
+            (dom.PAGE_START, "2", "1"),
+            (dom.PAGE_END, "2", "1"),
+            (dom.PAGE_END, "1", None),
+        ]
+
+    def test_recover(self, tmpdir):
+        document = get_document(tmpdir, XML.replace("<main/>", "<main>a & b</main>"))
+        assert document.backend == dom.BACKEND_LXML
+        assert len(document.getElementsByTagName("jahia:page")) == 2
+
+
+class TestDomCache:
+
+    def get_sites(self, tmpdir):
+        """Returns two fake sites, with 2 export files of 10 bytes each"""
+        Site = namedtuple('Site', ['export_files'])
+        sites = []
+        for name in ["site1", "site2"]:
+            export_files = {}
+            for language in ["en", "fr"]:
+                path = tmpdir.mkdir(name) if language == "en" else tmpdir.join(name)
+                path = path.join("export_%s.xml" % language)
+                path.write("0123456789")
+                export_files[language] = str(path)
+            sites.append(Site(export_files))
+        return sites
+
+    def test_hits_and_misses(self, tmpdir):
+        site, _ = self.get_sites(tmpdir)
+        cache = DomCache(max_size=100)
+        assert cache.get(site.export_files["en"]) is None
+        cache.add(site.export_files["en"], "dom")
+        assert cache.get(site.export_files["en"]) == "dom"
+        assert cache.get_stats() == {"hits": 1, "misses": 1, "evictions": 0}
+
+    def test_eviction_by_site(self, tmpdir):
+        site1, site2 = self.get_sites(tmpdir)
+        cache = DomCache(max_size=25)
+        cache.add(site1.export_files["en"], "dom")
+        cache.add(site1.export_files["fr"], "dom")
+        cache.add(site2.export_files["en"], "dom")
+        # the whole least recently used site is evicted
+        assert cache.get_stats()["evictions"] == 2
+        assert cache.size == 10
+        # the site being accessed is kept, even if it's too big
+        cache.add(site2.export_files["fr"], "dom")
+        cache.max_size = 10
+        cache.add(site1.export_files["en"], "dom")
+        assert cache.get(site1.export_files["en"]) == "dom"
+        assert cache.size == 10
+
+    def test_release(self, tmpdir):
+        site1, site2 = self.get_sites(tmpdir)
+        cache = DomCache(max_size=100)
+        for site in (site1, site2):
+            for path in site.export_files.values():
+                cache.add(path, "dom")
+        cache.release(site1)
+        assert cache.size == 20
+        assert cache.get(site1.export_files["fr"]) is None
+        assert cache.get(site2.export_files["fr"]) == "dom"
+
+    def test_add_again(self, tmpdir):
+        site, _ = self.get_sites(tmpdir)
+        cache = DomCache(max_size=100)
+        cache.add(site.export_files["en"], "dom")
+        cache.add(site.export_files["en"], "new dom")
+        # the former dom is replaced, not counted twice
+        assert cache.size == 10
+        assert cache.get(site.export_files["en"]) == "new dom"
@@ -0,0 +1,67 @@
+"""(c) All rights reserved. ECOLE POLYTECHNIQUE FEDERALE DE LAUSANNE, Switzerland, VPSI, 2017
+
+    Testing the rewriting of the links in the boxes HTML
+"""
+from bs4 import BeautifulSoup
+
+from parser.jahia_site import Site
+from parser.links import rewrite_links, LINK_ATTRIBUTES
+from parser.test.test_dom import XML
+
+
+def upper(tag_name, link):
+    return link.upper() + "?a=1&b='\""
+
+
+def rewrite_links_with_soup(content, rewrite):
+    """The links rewritten with BeautifulSoup, as they were before"""
+    soup = BeautifulSoup(content, 'html.parser')
+
+    for tag_name, attribute in LINK_ATTRIBUTES.items():
+        for tag in soup.find_all(tag_name):
+            link = tag.get(attribute)
+
+            if link:
+                tag[attribute] = rewrite(tag_name, link)
+
+    return str(soup)
+
+
+def test_only_links_are_changed():
+    content = '<p class=x>a &amp; b</p><A HREF="/a">a</A><img alt="/b" src=/b><a href="#">'
+
+    assert rewrite_links(content, lambda tag_name, link: None) is content
+    assert rewrite_links(content, upper) == \
+        '<p class=x>a &amp; b</p><A HREF="/A?a=1&amp;b=\'&quot;">a</A>' \
+        '<img alt="/b" src="/B?a=1&amp;b=\'&quot;"><a href="#?a=1&amp;b=\'&quot;">'
+
+
+def test_same_links_as_soup():
+    contents = [
+        '<a href="/a?x=1&amp;y=2">&nbsp;</a><script src="/b"></script>',
+        '<!-- <a href="/a"> --><![CDATA[<a href="/a">]]><a href="/a">',
+        '<script>var a = "<a href=\'/a\'>";</script><style>a[href="/a"] {}</style><a href=\'/a\'>',
+        '<a title="a > b" href="/a" href="/b"><a href><a href=""><a\nhref = "/a"\n/>',
+        '<p>a < b <a title=a"b href=/a></p><a href="/a',
+    ]
+
+    for content in contents:
+        assert str(BeautifulSoup(rewrite_links(content, upper), 'html.parser')) == \
+            rewrite_links_with_soup(content, upper)
+
+
+def test_links_after_ignored_link(tmpdir):
+    site_dir = tmpdir.mkdir("demo")
+    site_dir.join("site.properties").write("siteservername=demo.epfl.ch\n")
+    site_dir.join("export_en.xml").write(XML)
+    site = Site(str(site_dir), "demo")
+
+    box = site.get_all_boxes()[0]
+    box.content = '<a href="javascript:open()">j</a><a href="http://demo.epfl.ch/team">a</a><a href="#top">t</a>'
+    absolute_links, anchor_links = site.absolute_links, site.anchor_links
+    site.fix_links()
+
+    # the links following an ignored link are fixed and counted too
+    assert box.content == '<a href="javascript:open()">j</a><a href="/team">a</a><a href="#top">t</a>'
+    assert site.absolute_links == absolute_links + 1
+    assert site.anchor_links == anchor_links + 1
@@ -0,0 +1,114 @@
+"""(c) All rights reserved. ECOLE POLYTECHNIQUE FEDERALE DE LAUSANNE, Switzerland, VPSI, 2017
+
+    Testing the cache of the parsed sites
+"""
+import pickle
+
+import pytest
+
+from parser.jahia_site import Site
+from parser.parse_cache import ParseCache
+from parser.site_source import DirectorySource
+from parser.test.test_dom import XML
+
+
+@pytest.fixture()
+def site_dir(tmpdir):
+    site_dir = tmpdir.mkdir("demo")
+    site_dir.join("site.properties").write("siteservername=demo.epfl.ch\n")
+    site_dir.join("export_en.xml").write(XML)
+    return site_dir
+
+
+def save_site(site_dir, tmpdir):
+    site = Site(str(site_dir), "demo")
+    parse_cache = ParseCache(str(tmpdir), "demo")
+    parse_cache.save(site)
+    return parse_cache
+
+
+def test_load(site_dir, tmpdir):
+    parse_cache = save_site(site_dir, tmpdir)
+
+    source = DirectorySource(str(site_dir))
+    site = parse_cache.load(source, "")
+
+    assert sorted(site.pages_by_pid) == ["1", "2"]
+    assert site.source is source
+
+
+def test_stale(site_dir, tmpdir, monkeypatch):
+    parse_cache = save_site(site_dir, tmpdir)
+    source = DirectorySource(str(site_dir))
+
+    assert parse_cache.load(source, "/other") is None
+
+    monkeypatch.setattr(ParseCache, "parser_version", "other")
+    assert parse_cache.load(source, "") is None
+    monkeypatch.undo()
+
+    site_dir.join("export_en.xml").write(XML + " ")
+    assert parse_cache.load(source, "") is None
+
+    site_dir.join("export_en.xml").write(XML)
+    site_dir.join("export_fr.xml").write(XML)
+    assert parse_cache.load(source, "") is None
+
+
+def test_missing_or_invalid(site_dir, tmpdir):
+    parse_cache = ParseCache(str(tmpdir), "demo")
+    assert parse_cache.load(DirectorySource(str(site_dir)), "") is None
+
+    tmpdir.join(ParseCache.FILE_PATTERN % "demo").write("not a pickle")
+    assert parse_cache.load(DirectorySource(str(site_dir)), "") is None
+
+
+def test_lazy_load(site_dir, tmpdir):
+    parse_cache = save_site(site_dir, tmpdir)
+    site = parse_cache.load(DirectorySource(str(site_dir)), "")
+
+    # the report doesn't need the pages
+    assert site.get_report_info([])["pages"] == 2
+    assert "pages_by_pid" not in site.__dict__
+
+    # the loader is pickled with the Site, e.g. for the workers
+    site = pickle.loads(pickle.dumps(site))
+
+    page = site.pages_by_uuid[site.pages_by_pid["2"].uuid]
+    assert page.parent is site.homepage
+    assert site.homepage.children == [page]
+
+    page_content = page.contents["en"]
+    assert page_content.page is page and page_content.site is site
+    assert site.pages_content_by_path[page_content.path] is page_content
+    assert all(box.page_content.site is site for box in page_content.boxes + page_content.sidebar.boxes)
+
+    with pytest.raises(AttributeError):
+        site.missing
+
+
+def test_lazy_load_replaced(site_dir, tmpdir):
+    parse_cache = save_site(site_dir, tmpdir)
+    site = parse_cache.load(DirectorySource(str(site_dir)), "")
+
+    # the cache file is replaced before the pages are loaded
+    site_dir.join("export_fr.xml").write(XML)
+    save_site(site_dir, tmpdir)
+
+    for _ in range(2):
+        with pytest.raises(IOError):
+            site.pages_by_pid
+    assert "lazy_loader" in site.__dict__
+
+
+def test_parser_version(tmpdir, monkeypatch):
+    # e.g. utils.py, outside of the parser package
+    dependency = tmpdir.join("utils.py")
+    dependency.write("a = 1")
+    monkeypatch.setattr(ParseCache, "PARSER_DEPENDENCIES", (str(dependency),))
+    monkeypatch.setattr(ParseCache, "parser_version", None)
+    version = ParseCache.get_parser_version()
+
+    dependency.write("a = 2")
+    monkeypatch.setattr(ParseCache, "parser_version", None)
+    assert ParseCache.get_parser_version() != version
@@ -14,14 +14,24 @@ def get_sites():
     return ['dcsl', 'master']
 
 
+@pytest.fixture(scope='module',
+                params=[{}, {'streaming': True}, {'parse_workers': 2}],
+                ids=['dom', 'streaming', 'parse-workers'])
+def parse_options(request):
+    """
+    Parse the sites by loading their DOM, by streaming them, and in parse workers
+    """
+    return request.param
+
+
 @pytest.fixture(scope='module', params=get_sites())
-def site(request):
+def site(request, parse_options):
     """
     Load site only once
     """
     site_name = request.param
     site_data_path = os.path.join(DATA_PATH, request.param)
-    return Site(site_data_path, site_name)
+    return Site(site_data_path, site_name, **parse_options)
 
 
 @pytest.fixture()
@@ -0,0 +1,78 @@
+"""(c) All rights reserved. ECOLE POLYTECHNIQUE FEDERALE DE LAUSANNE, Switzerland, VPSI, 2017
+
+    Testing the sources of the site files: unzipped directory or zip
+"""
+import io
+import os
+import pickle
+import zipfile
+
+import pytest
+
+from parser import dom
+from parser.site_source import DirectorySource, ZipSource
+from parser.test.test_dom import XML
+
+SITE_FILES = {
+    "site.properties": "siteservername=demo.epfl.ch\n",
+    "export_en.xml": XML,
+    "content/sites/demo/files/doc.pdf/doc.pdf": "pdf",
+    "content/sites/demo/files/img/thumbnail": "thumbnail",
+}
+
+
+@pytest.fixture(params=[zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED], ids=["stored", "deflated"])
+def sources(request, tmpdir):
+    """Returns the sources of the same site: unzipped in a directory, and in its Jahia zip"""
+    site_zip = io.BytesIO()
+    with zipfile.ZipFile(site_zip, 'w', zipfile.ZIP_DEFLATED) as site:
+        for name, content in SITE_FILES.items():
+            site.writestr(name, content)
+            tmpdir.join("demo", name).write(content, ensure=True)
+
+    zip_file = str(tmpdir.join("demo_export.zip"))
+    with zipfile.ZipFile(zip_file, 'w', request.param) as export:
+        export.writestr("demo.zip", site_zip.getvalue())
+
+    path = str(tmpdir.join("demo"))
+    return DirectorySource(path), ZipSource(zip_file, "demo", path)
+
+
+def test_same_files(sources):
+    directory, zip_source = sources
+    path = directory.path
+
+    assert sorted(zip_source.listdir()) == sorted(directory.listdir())
+    assert sorted(zip_source.walk_files(path + "/content")) == sorted(directory.walk_files(path + "/content"))
+
+    for name in SITE_FILES:
+        file_path = os.path.join(path, name)
+        assert zip_source.get_size(file_path) == directory.get_size(file_path)
+        with zip_source.open(file_path) as zip_file, directory.open(file_path) as file:
+            assert zip_file.read() == file.read()
+
+    assert zip_source.exists(path + "/content")
+    assert not zip_source.exists(path + "/missing")
+    zip_source.close()
+
+
+def test_parse_from_zip(sources):
+    _, zip_source = sources
+    document = dom.parse(zip_source.path + "/export_en.xml", source=zip_source)
+    assert [page.getAttribute("jahia:pid") for page in document.getElementsByTagName("jahia:page")] == ["1", "2"]
+
+    pids = [element.get("{http://www.jahia.org/}pid") for event, element, parent_pid
+            in dom.iterparse_pages(zip_source.path + "/export_en.xml", source=zip_source)
+            if event == dom.PAGE_START]
+    assert pids == ["1", "2"]
+
+
+def test_pickle(sources):
+    _, zip_source = sources
+    zip_source.listdir()
+
+    # the zip is opened again when used
+    zip_source = pickle.loads(pickle.dumps(zip_source))
+    assert zip_source.site_zip is None
+    assert "site.properties" in zip_source.listdir()
+    zip_source.close()
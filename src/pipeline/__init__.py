@@ -0,0 +1,150 @@
+"""(c) All rights reserved. ECOLE POLYTECHNIQUE FEDERALE DE LAUSANNE, Switzerland, VPSI, 2017"""
+
+import logging
+import threading
+from multiprocessing.pool import Pool
+from queue import Queue
+
+"""
+    A staged pipeline, where each site goes through the stages (e.g. crawl -> unzip
+    -> parse -> export) as soon as the previous stage is done with it, instead of
+    waiting for all the other sites.
+
+    Each stage has its own workers, and the stages are linked by bounded queues:
+    when a stage is slower than the previous one, its queue fills up and the
+    previous stage waits.
+"""
+
+
+class Stage(object):
+    """
+        A stage of the Pipeline
+
+        'function' is called as function(site_name, value), with the value returned
+        by the previous stage, and returns the value for the next stage. If it returns
+        None or raises an exception, the site leaves the pipeline.
+
+        The stage runs 'workers' threads, for network-bound or disk-bound work. If
+        'processes' is True, the function is run in a pool of 'workers' processes,
+        for CPU-bound work. In that case the function, its arguments and its result
+        must be picklable.
+    """
+
+    def __init__(self, name, function, workers=1, processes=False):
+        self.name = name
+        self.function = function
+        self.workers = workers
+        self.processes = processes
+
+    def __str__(self):
+        return self.name
+
+
+class Pipeline(object):
+    """
+        Call Pipeline(stages).run(sites), where sites is an iterable of
+        (site_name, value) given to the first stage
+    """
+
+    # put in the queues when there is no more site to process
+    DONE = None
+
+    def __init__(self, stages, queue_size=4):
+        self.stages = stages
+        # the max number of sites waiting between two stages
+        self.queue_size = queue_size
+
+    def run(self, sites):
+        """
+            Run the sites through the stages. Yields (site_name, value) for each site
+            that went through all of them, in the order they are done
+        """
+        # queues[i] is the input of stages[i], the last one is the output
+        queues = [Queue(maxsize=self.queue_size) for _ in range(len(self.stages) + 1)]
+
+        pools = {}
+        threads = []
+
+        for stage in self.stages:
+            if stage.processes:
+                pools[stage] = Pool(processes=stage.workers)
+
+        try:
+            threads.append(threading.Thread(target=self.feed, args=(sites, queues[0])))
+
+            for index, stage in enumerate(self.stages):
+                # shared by the workers of the stage, to know which one is the last to stop
+                running = [stage.workers]
+                lock = threading.Lock()
+
+                for _ in range(stage.workers):
+                    threads.append(threading.Thread(
+                        target=self.work,
+                        args=(stage, pools.get(stage), queues[index], queues[index + 1], running, lock)))
+
+            for thread in threads:
+                thread.daemon = True
+                thread.start()
+
+            while True:
+                item = queues[-1].get()
+
+                if item is self.DONE:
+                    break
+
+                yield item
+
+        finally:
+            for pool in pools.values():
+                pool.terminate()
+
+    def feed(self, sites, output):
+        """Put the sites in the first queue"""
+        for site in sites:
+            output.put(site)
+
+        for _ in range(self.stages[0].workers):
+            output.put(self.DONE)
+
+    def work(self, stage, pool, input, output, running, lock):
+        """Process the sites of the input queue, until DONE"""
+        while True:
+            item = input.get()
+
+            if item is self.DONE:
+                break
+
+            site_name, value = item
+
+            try:
+                if pool:
+                    value = pool.apply(stage.function, (site_name, value))
+                else:
+                    value = stage.function(site_name, value)
+            except Exception as err:
+                logging.error("%s - %s - Exception: %s", site_name, stage, err)
+                continue
+
+            if value is not None:
+                output.put((site_name, value))
+
+        # the last worker tells the next stage that we are done
+        with lock:
+            running[0] -= 1
+            last = running[0] == 0
+
+        if last:
+            next_workers = self.get_next_workers(stage)
+
+            for _ in range(next_workers):
+                output.put(self.DONE)
+
+    def get_next_workers(self, stage):
+        """Returns the number of workers reading the output of the given stage"""
+        index = self.stages.index(stage)
+
+        if index + 1 < len(self.stages):
+            return self.stages[index + 1].workers
+
+        # the output of the last stage is read by run()
+        return 1
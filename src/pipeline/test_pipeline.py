@@ -0,0 +1,47 @@
+"""(c) All rights reserved. ECOLE POLYTECHNIQUE FEDERALE DE LAUSANNE, Switzerland, VPSI, 2017
+
+    Testing the staged pipeline
+"""
+import os
+
+from pipeline import Pipeline, Stage
+
+
+def double(site_name, value):
+    return value * 2
+
+
+def get_pid(site_name, value):
+    return value, os.getpid()
+
+
+def fail_on_b(site_name, value):
+    if site_name == "b":
+        raise ValueError("cannot process b")
+    return value
+
+
+class TestPipeline:
+
+    def test_all_sites_go_through_all_stages(self):
+        stages = [
+            Stage("double", double, workers=3),
+            Stage("add", lambda site_name, value: value + 1, workers=2),
+        ]
+        sites = [(str(i), i) for i in range(20)]
+        results = dict(Pipeline(stages, queue_size=2).run(sites))
+        assert results == {str(i): i * 2 + 1 for i in range(20)}
+
+    def test_processes(self):
+        stages = [Stage("pid", get_pid, workers=2, processes=True)]
+        results = dict(Pipeline(stages).run([("a", 1), ("b", 2)]))
+        assert results["a"][0] == 1 and results["b"][0] == 2
+        assert all(pid != os.getpid() for value, pid in results.values())
+
+    def test_failures_are_isolated(self):
+        stages = [
+            Stage("fail", fail_on_b),
+            Stage("skip c", lambda site_name, value: None if site_name == "c" else value),
+        ]
+        results = dict(Pipeline(stages).run([("a", 1), ("b", 2), ("c", 3), ("d", 4)]))
+        assert results == {"a": 1, "d": 4}
@@ -31,6 +31,35 @@ DATA_PATH = os.path.join(PROJECT_PATH, "jahia-data")
 EXPORT_PATH_DEFAULT = os.path.join(PROJECT_PATH, "exports")
 EXPORT_PATH = MainUtils.get_optional_env("EXPORT_PATH", EXPORT_PATH_DEFAULT)
 
+# max size of the Jahia XML files kept parsed in memory, in bytes
+DOM_CACHE_MAX_SIZE = int(MainUtils.get_optional_env("DOM_CACHE_MAX_SIZE", 256 * 1024 * 1024))
+
+# size of the chunks read and written when downloading the Jahia zip files, in MB
+DOWNLOAD_CHUNK_SIZE = int(MainUtils.get_optional_env("DOWNLOAD_CHUNK_SIZE", 4))
+
+# reserve the disk space of the Jahia zip files before downloading them. The
+# download of a process that is killed can't be resumed then
+DOWNLOAD_PREALLOCATE = MainUtils.get_optional_env("DOWNLOAD_PREALLOCATE", "no") == "yes"
+
+# min number of seconds between two logs of the download progress
+DOWNLOAD_PROGRESS_INTERVAL = 10
+
+# number of threads extracting the files of a Jahia zip, each one with its own handle on it.
+# Extracting is mostly disk-bound, but there is no point in having more threads than CPUs
+UNZIP_WORKERS = int(MainUtils.get_optional_env("UNZIP_WORKERS", min(4, os.cpu_count() or 1)))
+
+# max number of files open at the same time by the threads extracting a Jahia zip
+UNZIP_MAX_OPEN_FILES = int(MainUtils.get_optional_env("UNZIP_MAX_OPEN_FILES", 64))
+
+# number of threads sending the same kind of requests to the WordPress REST API, e.g.
+# the updates of the pages content
+WP_API_WORKERS = int(MainUtils.get_optional_env("WP_API_WORKERS", 8))
+
+# run the WP-CLI commands in a single process, loading WordPress once, instead of
+# one 'docker exec ... wp' process per command. Not by default: unlike separate
+# processes, the commands share the state of WordPress in memory
+WP_CLI_WORKER = MainUtils.get_optional_env("WP_CLI_WORKER", "no") == "yes"
+
 LINE_LENGTH_ON_PPRINT = 150
 LINE_LENGTH_ON_EXPORT = LINE_LENGTH_ON_PPRINT + 100
 
@@ -0,0 +1,127 @@
+"""(c) All rights reserved. ECOLE POLYTECHNIQUE FEDERALE DE LAUSANNE, Switzerland, VPSI, 2017
+
+    Testing the unzip of the Jahia export files
+"""
+import io
+import os
+import zipfile
+
+import pytest
+
+import unzipper.unzip
+from unzipper.unzip import unzip_one, get_metadata_only_zip, UNZIP_MARKER
+
+SITE_FILES = {
+    "site.properties": "siteservername=demo.epfl.ch\n",
+    "export_en.xml": "<jahia:page/>",
+    "content/sites/demo/files/doc.pdf/doc.pdf": "pdf",
+}
+
+
+def make_export_zip(tmpdir, compression, site_files=SITE_FILES, file_name="demo_export_2017-01-15-23-00.zip"):
+    """
+    Make a Jahia export zip, containing the demo.zip site zip
+    """
+    site_zip = io.BytesIO()
+    with zipfile.ZipFile(site_zip, 'w', zipfile.ZIP_DEFLATED) as site:
+        for name, content in site_files.items():
+            site.writestr(name, content)
+
+    path = str(tmpdir.join(file_name))
+    with zipfile.ZipFile(path, 'w', compression) as export:
+        export.writestr("demo.zip", site_zip.getvalue())
+        export.writestr("users.xml", "<users/>")
+    return path
+
+
+@pytest.mark.parametrize("compression", [zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED], ids=["stored", "deflated"])
+def test_unzip_one(tmpdir, compression):
+    zip_file = make_export_zip(tmpdir, compression)
+    output_dir = tmpdir.mkdir("build")
+
+    unzip_path = unzip_one(str(output_dir), "demo", zip_file)
+
+    assert unzip_path == str(output_dir.join("demo", "demo"))
+    for name, content in SITE_FILES.items():
+        with open(os.path.join(unzip_path, name)) as site_file:
+            assert site_file.read() == content
+
+    # the site zip is not extracted
+    assert sorted(os.listdir(str(output_dir.join("demo")))) == ["demo"]
+
+
+@pytest.mark.parametrize("compression", [zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED], ids=["stored", "deflated"])
+def test_unzip_one_in_parallel(tmpdir, monkeypatch, compression):
+    site_files = {"content/sites/demo/files/%s/file_%s.txt" % (i % 7, i): "file %s" % i for i in range(50)}
+    site_files.update(SITE_FILES)
+    zip_file = make_export_zip(tmpdir, compression, site_files)
+    output_dir = tmpdir.mkdir("build")
+
+    # extract with 3 workers, and through a temporary file when deflated
+    monkeypatch.setattr(unzipper.unzip, "PARALLEL_MIN_FILES", 10)
+    monkeypatch.setattr(unzipper.unzip, "UNZIP_WORKERS", 3)
+    monkeypatch.setattr(unzipper.unzip, "IN_MEMORY_MAX_SIZE", 0)
+
+    unzip_path = unzip_one(str(output_dir), "demo", zip_file)
+
+    for name, content in site_files.items():
+        with open(os.path.join(unzip_path, name)) as site_file:
+            assert site_file.read() == content
+
+    assert sorted(os.listdir(str(output_dir.join("demo")))) == ["demo"]
+
+
+@pytest.mark.parametrize("compression", [zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED], ids=["stored", "deflated"])
+def test_unzip_metadata_only(tmpdir, compression):
+    zip_file = make_export_zip(tmpdir, compression)
+    output_dir = tmpdir.mkdir("build")
+
+    unzip_path = unzip_one(str(output_dir), "demo", zip_file, metadata_only=True)
+
+    # the files are not extracted, the parser reads them from the zip
+    assert not os.path.exists(os.path.join(unzip_path, "content"))
+    assert os.path.isfile(os.path.join(unzip_path, "export_en.xml"))
+    assert get_metadata_only_zip(unzip_path) == os.path.abspath(zip_file)
+
+    # the next full unzip extracts them
+    assert unzip_one(str(output_dir), "demo", zip_file) == unzip_path
+    assert os.path.isfile(os.path.join(unzip_path, "content/sites/demo/files/doc.pdf/doc.pdf"))
+    assert get_metadata_only_zip(unzip_path) is None
+
+
+def test_unzip_cache(tmpdir, monkeypatch):
+    zip_file = make_export_zip(tmpdir, zipfile.ZIP_STORED)
+    output_dir = str(tmpdir.mkdir("build"))
+    unzip_path = unzip_one(output_dir, "demo", zip_file)
+
+    extracted = []
+    extract_site_zip = unzipper.unzip.extract_site_zip
+    monkeypatch.setattr(unzipper.unzip, "extract_site_zip",
+                        lambda *args, **kwargs: extracted.append(args) or extract_site_zip(*args, **kwargs))
+
+    # the same snapshot, even in another file, is not extracted again
+    unzip_one(output_dir, "demo", zip_file)
+    unzip_one(output_dir, "demo", make_export_zip(tmpdir, zipfile.ZIP_STORED, file_name="copy.zip"))
+    assert extracted == []
+
+    # a new snapshot is
+    site_files = {"export_fr.xml": "<jahia:page/>"}
+    site_files.update(SITE_FILES)
+    unzip_one(output_dir, "demo", make_export_zip(tmpdir, zipfile.ZIP_STORED, site_files, file_name="new.zip"))
+    assert len(extracted) == 1
+    assert os.path.isfile(os.path.join(unzip_path, "export_fr.xml"))
+
+    # and so is an interrupted extraction, the files of the other snapshot are removed
+    os.remove(os.path.join(unzip_path, UNZIP_MARKER))
+    unzip_one(output_dir, "demo", zip_file)
+    assert len(extracted) == 2
+    assert not os.path.exists(os.path.join(unzip_path, "export_fr.xml"))
+
+
+def test_missing_site_zip(tmpdir):
+    path = str(tmpdir.join("demo_export.zip"))
+    with zipfile.ZipFile(path, 'w') as export:
+        export.writestr("other.zip", "")
+
+    with pytest.raises(ValueError):
+        unzip_one(str(tmpdir.mkdir("build")), "demo", path)
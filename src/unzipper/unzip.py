@@ -1,46 +1,336 @@
 """(c) All rights reserved. ECOLE POLYTECHNIQUE FEDERALE DE LAUSANNE, Switzerland, VPSI, 2017"""
+import io
+import json
 import os
 import logging
+import shutil
+import struct
+import tempfile
+import timeit
 import zipfile
+from contextlib import contextmanager
+from functools import partial
+from multiprocessing.pool import ThreadPool
 
+from crawler.manifest import Manifest
+from settings import UNZIP_WORKERS, UNZIP_MAX_OPEN_FILES
 
-def unzip_one(output_dir, site_name, zip_file):
+# the site zip is decompressed in memory up to this size when it's compressed
+# in the export zip, and in a temporary file above
+IN_MEMORY_MAX_SIZE = 64 * 1024 * 1024
+
+# under this number of files, the site zip is extracted by one worker
+PARALLEL_MIN_FILES = 1000
+
+# the directory of the files (pdf, images...) in the site zip
+FILES_DIR = "content/"
+
+# written in the site directory once the site is extracted, see unzip_one
+UNZIP_MARKER = ".unzip.json"
+
+# each worker has its own handle on the site zip, and writes one file at a time
+OPEN_FILES_PER_WORKER = 2
+
+
+class FileRange(io.RawIOBase):
+    """A read-only file over a range of bytes of another file, e.g. a member of a zip"""
+
+    def __init__(self, path, start, size):
+        self.file = open(path, 'rb')
+        self.start = start
+        self.size = size
+        self.position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.position
+        elif whence == io.SEEK_END:
+            offset += self.size
+
+        self.position = max(offset, 0)
+        return self.position
+
+    def readinto(self, buffer):
+        size = min(len(buffer), self.size - self.position)
+
+        if size <= 0:
+            return 0
+
+        self.file.seek(self.start + self.position)
+        read = self.file.readinto(memoryview(buffer)[:size])
+        self.position += read
+        return read
+
+    def close(self):
+        self.file.close()
+        super().close()
+
+
+def get_data_offset(zip_file, zip_info):
+    """
+    Returns the offset of the data of the given member in the zip file, after its local header
+    """
+    with open(zip_file, 'rb') as input:
+        input.seek(zip_info.header_offset)
+        header = struct.unpack(zipfile.structFileHeader, input.read(zipfile.sizeFileHeader))
+
+    if header[0] != zipfile.stringFileHeader:
+        raise zipfile.BadZipFile("Bad magic number for file header of %s" % zip_info.filename)
+
+    # the file name length and the extra field length
+    return zip_info.header_offset + zipfile.sizeFileHeader + header[10] + header[11]
+
+
+def open_range(path, start, size):
+    """Returns a new buffered file over the given range of bytes of the file"""
+    return io.BufferedReader(FileRange(path, start, size), buffer_size=1024 * 1024)
+
+
+def get_workers(nb_files):
+    """Returns the number of workers extracting the given number of files"""
+    if nb_files < PARALLEL_MIN_FILES:
+        return 1
+
+    return max(1, min(UNZIP_WORKERS, UNZIP_MAX_OPEN_FILES // OPEN_FILES_PER_WORKER))
+
+
+def extract_members(open_site_zip, names, unzip_path):
+    """Extract the given members, with a new handle on the site zip"""
+    with open_site_zip() as site_file, zipfile.ZipFile(site_file, 'r') as site_zip:
+        for name in names:
+            site_zip.extract(name, unzip_path)
+
+
+def is_metadata(name):
+    """
+    Returns True if the given member of the site zip is needed to parse the site,
+    i.e. it's not one of the files (pdf, images...) under content/
+    """
+    return not name.startswith(FILES_DIR)
+
+
+def extract_site_zip(site_file, unzip_path, open_site_zip=None, metadata_only=False):
+    """
+    Extract the site zip read from site_file. If open_site_zip is given, it returns
+    a new file on the site zip, and big sites are extracted by several workers, each
+    one with its own handle on the zip and its own range of members
+    """
+    start_time = timeit.default_timer()
+
+    with zipfile.ZipFile(site_file, 'r') as site_zip:
+        infos = site_zip.infolist()
+
+        if metadata_only:
+            infos = [info for info in infos if is_metadata(info.filename)]
+
+        workers = get_workers(len(infos)) if open_site_zip else 1
+
+        if workers == 1:
+            site_zip.extractall(unzip_path, infos)
+
+    if workers > 1:
+        # the members in the order they are stored, so that each worker reads forward
+        infos.sort(key=lambda info: info.header_offset)
+
+        # the directories are created first, the workers would race to create them
+        for directory in sorted({os.path.dirname(info.filename) for info in infos}):
+            os.makedirs(os.path.join(unzip_path, directory), exist_ok=True)
+
+        ranges = []
+        for index in range(workers):
+            members = infos[index * len(infos) // workers:(index + 1) * len(infos) // workers]
+            ranges.append([info.filename for info in members])
+
+        with ThreadPool(processes=workers) as pool:
+            pool.map(partial(extract_members, open_site_zip, unzip_path=unzip_path), ranges)
+
+    elapsed = timeit.default_timer() - start_time
+    logging.info("Extracted %s files with %s worker(s) in %.2fs (%.0f files/s)",
+                 len(infos), workers, elapsed, len(infos) / elapsed if elapsed else 0)
+
+
+@contextmanager
+def open_site_zip(zip_file, site_name, tmp_dir=None):
+    """
+    Open the site zip, i.e. <site_name>.zip in the Jahia export zip, without extracting it.
+    Yields (site_file, open_site_zip): the site zip, and a function returning a new file
+    on it, or None if it can't be opened more than once
+    """
+    # create zipFile to manipulate / extract zip content
+    with zipfile.ZipFile(zip_file, 'r') as export_zip:
+
+        # make sure we have the zip containing the site
+        zip_name = "%s.zip" % site_name
+        if zip_name not in export_zip.namelist():
+            logging.error("%s - unzip - zip file %s not found in main zip", site_name, zip_name)
+            raise ValueError("Jahia zip file does not contain site file")
+
+        zip_info = export_zip.getinfo(zip_name)
+
+        if zip_info.compress_type == zipfile.ZIP_STORED:
+            # read in place, each worker opens the range of the export zip where it's stored
+            open_range_file = partial(open_range, zip_file, get_data_offset(zip_file, zip_info), zip_info.file_size)
+
+            with open_range_file() as site_file:
+                yield site_file, open_range_file
+
+        elif zip_info.file_size <= IN_MEMORY_MAX_SIZE:
+            # small enough to be decompressed in memory, and extracted by one worker
+            with io.BytesIO(export_zip.read(zip_info)) as site_file:
+                yield site_file, None
+
+        else:
+            # decompressed in a temporary file, that each worker opens
+            with tempfile.NamedTemporaryFile(dir=tmp_dir, suffix=".zip") as site_file:
+                with export_zip.open(zip_info) as member:
+                    shutil.copyfileobj(member, site_file, 1024 * 1024)
+                site_file.flush()
+
+                yield site_file, partial(open, site_file.name, 'rb')
+
+
+def read_unzip_marker(unzip_path):
+    """
+    Returns the content of the marker written once the site is extracted in the given
+    path, or None if the extraction is not complete:
+
+    * 'checksum': the sha256 of the Jahia export zip
+    * 'zip_file', 'size' & 'mtime': the zip file, to check if it changed without reading it
+    * 'metadata_only': True if only the files needed to parse the site were extracted
+    """
+    marker = os.path.join(unzip_path, UNZIP_MARKER)
+
+    if not os.path.isfile(marker):
+        return None
+
+    try:
+        with open(marker) as marker_file:
+            return json.load(marker_file)
+    except ValueError as err:
+        logging.warning("Invalid unzip marker %s: %s", marker, err)
+        return None
+
+
+def write_unzip_marker(unzip_path, data):
+    """Write the marker, atomically so that it's never half written"""
+    marker = os.path.join(unzip_path, UNZIP_MARKER)
+
+    with open(marker + ".tmp", 'w') as marker_file:
+        json.dump(data, marker_file, indent=2, sort_keys=True)
+
+    os.replace(marker + ".tmp", marker)
+
+
+def get_zip_checksum(zip_file, site_name):
+    """
+    Returns the sha256 of the Jahia export zip. It's taken from the crawler manifest
+    if the zip is the snapshot it describes, computed otherwise
+    """
+    manifest = Manifest(os.path.dirname(zip_file), site_name)
+    snapshot = manifest.get_snapshot()
+
+    if snapshot and os.path.samefile(snapshot, zip_file) and manifest.data.get('checksum'):
+        return manifest.data['checksum']
+
+    return Manifest.get_checksum(zip_file)
+
+
+def get_metadata_only_zip(unzip_path):
+    """
+    Returns the Jahia export zip if only the metadata of the site were extracted
+    in the given path, or None
+    """
+    marker = read_unzip_marker(unzip_path)
+
+    if not marker or not marker.get('metadata_only'):
+        return None
+
+    return marker['zip_file']
+
+
+def get_unzip_path(output_dir, site_name):
+    """Returns the path where the site files are unzipped"""
+    return os.path.join(output_dir, site_name, site_name)
+
+
+def unzip_one(output_dir, site_name, zip_file, metadata_only=False):
+    """
+    Unzip the site files in <output_dir>/<site_name>/<site_name>, and returns this path.
+    If metadata_only is True, only the files needed to parse the site are extracted,
+    the parser reads the others from the zip (see site_source). They are extracted by the next full unzip
+
+    The extraction is skipped if it was completed from a zip with the same checksum.
+    Otherwise, e.g. for a new snapshot or after an interrupted extraction, the
+    directory is extracted again
+    """
     # create subdir in output_dir
     output_subdir = os.path.join(output_dir, site_name)
     if output_subdir:
         if not os.path.isdir(output_subdir):
             os.mkdir(output_subdir)
 
-    # check if unzipped files already exists
-    unzip_path = os.path.join(output_subdir, site_name)
-    if os.path.isdir(unzip_path):
-        logging.info("Already unzipped %s" % unzip_path)
-        return unzip_path
-
-    logging.info("Unzipping %s..." % zip_file)
-
     # make sure we have an input file
     if not zip_file or not os.path.isfile(zip_file):
         logging.error("%s - unzip - Jahia zip file %s not found", site_name, zip_file)
         raise ValueError("Jahia zip file not found")
 
-    # create zipFile to manipulate / extract zip content
-    export_zip = zipfile.ZipFile(zip_file, 'r')
-
-    # make sure we have the zip containing the site
-    zip_name = "%s.zip" % site_name
-    if zip_name not in export_zip.namelist():
-        logging.error("%s - unzip - zip file %s not found in main zip", site_name, zip_name)
-        raise ValueError("Jahia zip file does not contain site file")
-
-    # extract the export zip file
-    export_zip.extractall(output_subdir)
-    export_zip.close()
-
-    # unzip the zip with the files
-    zip_path = os.path.join(output_subdir, zip_name)
-    zip_ref_with_files = zipfile.ZipFile(zip_path, 'r')
-    zip_ref_with_files.extractall(unzip_path)
+    unzip_path = get_unzip_path(output_dir, site_name)
+    stat = os.stat(zip_file)
+    zip_data = {'zip_file': os.path.abspath(zip_file), 'size': stat.st_size, 'mtime': stat.st_mtime}
+
+    # check if the files were already unzipped from the same zip. The checksum
+    # is only needed if the zip file is not the one we know
+    marker = read_unzip_marker(unzip_path)
+    checksum = None
+    same_zip = False
+
+    if marker:
+        if all(marker.get(key) == value for key, value in zip_data.items()):
+            checksum = marker['checksum']
+        else:
+            checksum = get_zip_checksum(zip_file, site_name)
+
+        same_zip = checksum == marker.get('checksum')
+
+        if same_zip and (metadata_only or not marker.get('metadata_only')):
+            if marker['zip_file'] != zip_data['zip_file'] or marker['mtime'] != zip_data['mtime']:
+                marker.update(zip_data)
+                write_unzip_marker(unzip_path, marker)
+
+            logging.info("Already unzipped %s" % unzip_path)
+            return unzip_path
+
+    # remove what was extracted from another zip, or not completely
+    if not same_zip and os.path.isdir(unzip_path):
+        logging.info("Removing %s, extracted from another zip or interrupted", unzip_path)
+        shutil.rmtree(unzip_path)
+
+    # the files already extracted from the same zip are kept, but they are not complete anymore
+    if same_zip:
+        os.remove(os.path.join(unzip_path, UNZIP_MARKER))
+
+    logging.info("Unzipping %s..." % zip_file)
+
+    if checksum is None:
+        checksum = get_zip_checksum(zip_file, site_name)
+
+    # unzip the zip with the files, straight from the export zip
+    with open_site_zip(zip_file, site_name, tmp_dir=output_subdir) as (site_file, open_site_file):
+        extract_site_zip(site_file, unzip_path, open_site_file, metadata_only=metadata_only)
+
+    # the extraction is complete
+    os.makedirs(unzip_path, exist_ok=True)
+    zip_data.update(checksum=checksum, metadata_only=metadata_only)
+    write_unzip_marker(unzip_path, zip_data)
 
     logging.info("Site successfully extracted in %s" % unzip_path)
     return unzip_path
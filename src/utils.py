@@ -2,49 +2,133 @@
 
 import logging
 import os
-import xml.dom.minidom
+from collections import OrderedDict
 
 import requests
-from bs4 import BeautifulSoup
 from fabric.api import env, cd, run
 from fabric.contrib.files import exists
 
 from urllib.parse import urlsplit
 
+from parser import dom as jahia_dom
 
-class Utils:
-    # the cache with all the doms
-    dom_cache = {}
 
+class DomCache:
+    """
+    LRU cache of the parsed export files, bounded by the size of their XML
+    source. The doms are grouped by site (i.e. by directory): the least
+    recently used sites are evicted, but never the one being accessed, so the
+    export files of a site stay together until the site is released
+    """
+
+    def __init__(self, max_size):
+        # the max size of the cached XML files, in bytes
+        self.max_size = max_size
+        self.size = 0
+        # the doms by site directory, from the least to the most recently used.
+        # The values are dicts with the path as key and a (dom, size) tuple as value
+        self.sites = OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, path):
+        """Returns the dom of the given XML file path, or None"""
+        scope = os.path.dirname(path)
+
+        if path in self.sites.get(scope, {}):
+            self.hits += 1
+            self.sites.move_to_end(scope)
+            return self.sites[scope][path][0]
+
+        self.misses += 1
+        return None
+
+    def add(self, path, dom, size=None):
+        """Add the dom of the given XML file path, evicting other sites if needed"""
+        scope = os.path.dirname(path)
+
+        if size is None:
+            size = os.path.getsize(path)
+
+        doms = self.sites.setdefault(scope, {})
+
+        # the dom replaces the one already cached, if any
+        if path in doms:
+            self.size -= doms[path][1]
+
+        doms[path] = (dom, size)
+        self.sites.move_to_end(scope)
+        self.size += size
+
+        while self.size > self.max_size and len(self.sites) > 1:
+            evicted_scope, doms = self.sites.popitem(last=False)
+            logging.debug("Evicting %s doms of %s from cache", len(doms), evicted_scope)
+            self.size -= sum(size for dom, size in doms.values())
+            self.evictions += len(doms)
+
+    def release(self, site):
+        """Remove the doms of the given site"""
+        for path in site.export_files.values():
+            doms = self.sites.get(os.path.dirname(path), {})
+
+            if path in doms:
+                self.size -= doms.pop(path)[1]
+
+                if not doms:
+                    del self.sites[os.path.dirname(path)]
+
+    def get_stats(self):
+        """Returns the counters, as a dict"""
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+
+class Utils:
     """Various utilities"""
+
+    # the cache with all the doms, created when first used
+    dom_cache = None
+
     @staticmethod
     def get_tag_attribute(dom, tag, attribute):
-        """Returns the given attribute of the given tag"""
-        elements = dom.getElementsByTagName(tag)
+        """Returns the given attribute of the first given tag"""
+        element = dom.get_first_element_by_tag_name(tag)
 
-        if not elements:
+        if element is None:
             return ""
 
-        return elements[0].getAttribute(attribute)
+        return element.getAttribute(attribute)
 
     @classmethod
-    def get_dom(cls, path):
-        """Returns the dom of the given XML file path"""
+    def get_dom_cache(cls):
+        """Returns the cache of the doms"""
+        if cls.dom_cache is None:
+            from settings import DOM_CACHE_MAX_SIZE
+            cls.dom_cache = DomCache(max_size=DOM_CACHE_MAX_SIZE)
 
-        # we check the cache first
-        if path in cls.dom_cache:
-            return cls.dom_cache[path]
+        return cls.dom_cache
 
-        # load the xml
-        xml_file = open(path, "r")
+    @classmethod
+    def get_dom(cls, path, source=None):
+        """Returns the dom of the given XML file path, read from the given site source if any"""
 
-        # we use BeautifulSoup first because some XML files are invalid
-        xml_soup = BeautifulSoup(xml_file.read(), 'xml')
+        # we check the cache first
+        dom = cls.get_dom_cache().get(path)
+        if dom is not None:
+            return dom
 
-        dom = xml.dom.minidom.parseString(str(xml_soup))
+        # parse the xml only once, BeautifulSoup is used only for
+        # the invalid XML files that lxml can not recover
+        dom = jahia_dom.parse(path, source=source)
+        logging.info("Loaded %s with %s", path, dom.backend)
 
         # save in the cache
-        cls.dom_cache[path] = dom
+        cls.get_dom_cache().add(path, dom, size=source.get_size(path) if source else None)
 
         return dom
 